@@ -0,0 +1,136 @@
+#!/usr/bin/python3
+"""Semantic cache of answered questions for question_to_sql.py.
+
+Answers are stored in a local SQLite database with the embedding of their question. A new question is answered from
+the cache when its embedding has a cosine similarity above the threshold with a previously answered, unexpired
+question. Entries expire after the TTL and the least recently used are evicted once the capacity is reached.
+
+Configured through the environment:
+    ANSWER_CACHE - set to 1 to enable the cache (default 0)
+    ANSWER_CACHE_PATH - location of the SQLite database (default answer_cache.db)
+    ANSWER_CACHE_THRESHOLD - minimum cosine similarity for a hit (default 0.95)
+    ANSWER_CACHE_TTL_SECONDS - lifetime of an answer (default 604800 i.e. 7 days)
+    ANSWER_CACHE_CAPACITY - maximum number of answers (default 1000)
+    ANSWER_CACHE_LOOKUPS - number of recent lookups kept for the statistics (default 10000)
+
+Run this module directly to print the hit rate and similarity scores of the recent lookups, which can be used to tune
+the threshold.
+"""
+import array
+import os
+import time
+import numpy as np
+from sqlite_cache import SQLiteCache, print_stats
+from vector_index import VectorIndex
+
+
+class AnswerCache(SQLiteCache):
+
+    def __init__(self, path="answer_cache.db", threshold=0.95, ttl=7 * 24 * 3600, capacity=1000, lookups=10000):
+        super().__init__(path)
+        self.threshold = threshold
+        self.ttl = ttl
+        self.capacity = capacity
+        self.lookups = lookups
+        self._index = None
+        self._index_version = None
+        with self._connection() as conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS answers (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                question TEXT NOT NULL,
+                embedding BLOB NOT NULL,
+                answer TEXT NOT NULL,
+                created REAL NOT NULL,
+                accessed REAL NOT NULL)""")
+            conn.execute("CREATE INDEX IF NOT EXISTS answers_accessed ON answers (accessed)")
+            conn.execute("""CREATE TABLE IF NOT EXISTS lookups (
+                created REAL NOT NULL,
+                similarity REAL,
+                hit INTEGER NOT NULL)""")
+            conn.execute("CREATE INDEX IF NOT EXISTS lookups_created ON lookups (created)")
+
+    def _candidates(self, conn):
+        # the index is only rebuilt when answers have been added, removed or have expired
+        cutoff = time.time() - self.ttl
+        version = conn.execute("SELECT count(), max(id) FROM answers WHERE created > ?", (cutoff,)).fetchone()
+        with self._lock:
+            if self._index is None or version != self._index_version:
+                rows = conn.execute("SELECT id, embedding FROM answers WHERE created > ?", (cutoff,)).fetchall()
+                self._index = VectorIndex([array.array("f", row[1]).tolist() for row in rows],
+                                          [row[0] for row in rows], metric="cosine")
+                self._index_version = version
+            return self._index
+
+    def lookup(self, embedding):
+        """Returns (question, answer, similarity) for the most similar cached question above the threshold, or None"""
+        conn = self._connection()
+        index = self._candidates(conn)
+        similarity = None
+        result = None
+        if len(index) > 0 and embedding:
+            distances = index.distances([embedding])[0]
+            nearest = int(np.argmin(distances))
+            similarity = float(1 - distances[nearest])
+            if similarity >= self.threshold:
+                answer_id = index.payloads[nearest]
+                row = conn.execute("SELECT question, answer FROM answers WHERE id = ?", (answer_id,)).fetchone()
+                if row is not None:
+                    result = (row[0], row[1], similarity)
+        with conn:
+            if result is not None:
+                conn.execute("UPDATE answers SET accessed = ? WHERE id = ?", (time.time(), answer_id))
+            now = time.time()
+            conn.execute("INSERT INTO lookups (created, similarity, hit) VALUES (?, ?, ?)",
+                         (now, similarity, result is not None))
+            # only the recent lookups are kept, so the table and stats() stay bounded
+            conn.execute("DELETE FROM lookups WHERE created <= ?", (now - self.ttl,))
+            conn.execute("DELETE FROM lookups WHERE rowid <= (SELECT max(rowid) FROM lookups) - ?", (self.lookups,))
+        return result
+
+    def store(self, question, embedding, answer):
+        if not embedding:
+            return
+        now = time.time()
+        with self._connection() as conn:
+            conn.execute("INSERT INTO answers (question, embedding, answer, created, accessed) VALUES (?, ?, ?, ?, ?)",
+                         (question, array.array("f", embedding).tobytes(), answer, now, now))
+            conn.execute("DELETE FROM answers WHERE created <= ?", (now - self.ttl,))
+            conn.execute("DELETE FROM answers WHERE id IN (SELECT id FROM answers ORDER BY accessed DESC "
+                         "LIMIT -1 OFFSET ?)", (self.capacity,))
+
+    def stats(self):
+        conn = self._connection()
+        lookups, hits = conn.execute("SELECT count(), COALESCE(SUM(hit), 0) FROM lookups").fetchone()
+        similarities = [row[0] for row in conn.execute("SELECT similarity FROM lookups WHERE similarity IS NOT NULL")]
+        stats = {
+            "entries": conn.execute("SELECT count() FROM answers").fetchone()[0],
+            "lookups": lookups,
+            "hits": hits,
+            "hit_rate": hits / lookups if lookups else 0.0,
+            "threshold": self.threshold,
+        }
+        if similarities:
+            for p in (10, 50, 90, 99):
+                stats[f"similarity_p{p}"] = float(np.percentile(similarities, p))
+        return stats
+
+
+_cache = None
+
+
+def get_answer_cache():
+    """Returns the process wide cache configured from the environment, or None if disabled"""
+    global _cache
+    if os.getenv("ANSWER_CACHE", default="0") != "1":
+        return None
+    if _cache is None:
+        _cache = AnswerCache(path=os.getenv("ANSWER_CACHE_PATH", default="answer_cache.db"),
+                             threshold=float(os.getenv("ANSWER_CACHE_THRESHOLD", default=0.95)),
+                             ttl=int(os.getenv("ANSWER_CACHE_TTL_SECONDS", default=7 * 24 * 3600)),
+                             capacity=int(os.getenv("ANSWER_CACHE_CAPACITY", default=1000)),
+                             lookups=int(os.getenv("ANSWER_CACHE_LOOKUPS", default=10000)))
+    return _cache
+
+
+if __name__ == '__main__':
+    print_stats(get_answer_cache(), "answer cache is disabled, set ANSWER_CACHE=1")
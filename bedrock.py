@@ -1,11 +1,16 @@
 """Helper utilities for working with Amazon Bedrock from Python notebooks"""
 import os
+import re
 from typing import Optional
 from io import StringIO
 import sys
 import textwrap
 import boto3
 from botocore.config import Config
+from botocore.credentials import RefreshableCredentials
+from botocore.session import get_session
+from urllib.parse import unquote
+from rate_limiter import get_rate_limiter
 
 
 def print_ww(*args, width: int = 100, **kwargs):
@@ -22,11 +27,44 @@ def print_ww(*args, width: int = 100, **kwargs):
         print("\n".join(textwrap.wrap(line, width=width)))
 
 
+def limiter_for_url(url: str):
+    match = re.search(r"/model/([^/]+)/invoke", url)
+    if match is None:
+        return None
+    return get_rate_limiter(unquote(match.group(1)))
+
+
+def register_rate_limiter(client):
+    """Acquires from the shared rate limiter before each request attempt and adapts it from the response"""
+
+    def before_send(request, **kwargs):
+        limiter = limiter_for_url(request.url)
+        if limiter is not None:
+            limiter.acquire()
+
+    def needs_retry(response, request_dict, **kwargs):
+        limiter = limiter_for_url(request_dict["url"])
+        if limiter is None or response is None:
+            return None
+        http_response, parsed = response
+        if parsed.get("Error", {}).get("Code") == "ThrottlingException":
+            limiter.throttled()
+        elif http_response.status_code < 400:
+            limiter.succeeded()
+        return None
+
+    client.meta.events.register("before-send.bedrock-runtime", before_send)
+    client.meta.events.register("needs-retry.bedrock-runtime", needs_retry)
+
+
 def get_bedrock_client(
     assumed_role: Optional[str] = None,
     region: Optional[str] = None,
     runtime: Optional[bool] = True,
-    silent = False
+    silent = False,
+    max_pool_connections: Optional[int] = None,
+    rate_limit: Optional[bool] = False,
+    max_attempts: Optional[int] = 10
 ):
     """Create a boto3 client for Amazon Bedrock, with optional configuration overrides
 
@@ -42,6 +80,15 @@ def get_bedrock_client(
         Optional choice of getting different client to perform operations with the Amazon Bedrock service.
     silent :
         Print logs
+    max_pool_connections :
+        Optional maximum number of pooled HTTP connections. Should be at least the number of threads
+        sharing the client. If not specified, the botocore default (10) is used.
+    rate_limit :
+        Pace every request, including botocore retries, through the adaptive rate limiter shared by all
+        processes on the host. See rate_limiter.py.
+    max_attempts :
+        Total attempts botocore makes for each request, including the first. Set to 1 when the caller
+        retries itself e.g. with tenacity, so every retry is visible to it.
     """
     if region is None:
         target_region = os.environ.get("AWS_REGION", os.environ.get("AWS_DEFAULT_REGION"))
@@ -58,12 +105,16 @@ def get_bedrock_client(
             print(f"  Using profile: {profile_name}")
         session_kwargs["profile_name"] = profile_name
 
+    config_kwargs = {}
+    if max_pool_connections:
+        config_kwargs["max_pool_connections"] = max_pool_connections
     retry_config = Config(
         region_name=target_region,
         retries={
-            "max_attempts": 10,
+            "max_attempts": max_attempts,
             "mode": "standard",
         },
+        **config_kwargs
     )
     session = boto3.Session(**session_kwargs)
 
@@ -71,15 +122,29 @@ def get_bedrock_client(
         if not silent:
             print(f"  Using role: {assumed_role}", end='')
         sts = session.client("sts")
-        response = sts.assume_role(
-            RoleArn=str(assumed_role),
-            RoleSessionName="langchain-llm-1"
+
+        def assume_role():
+            response = sts.assume_role(
+                RoleArn=str(assumed_role),
+                RoleSessionName="langchain-llm-1"
+            )
+            return {
+                "access_key": response["Credentials"]["AccessKeyId"],
+                "secret_key": response["Credentials"]["SecretAccessKey"],
+                "token": response["Credentials"]["SessionToken"],
+                "expiry_time": response["Credentials"]["Expiration"].isoformat(),
+            }
+
+        # botocore calls assume_role again shortly before the credentials expire, so long-lived clients keep working
+        botocore_session = get_session()
+        botocore_session._credentials = RefreshableCredentials.create_from_metadata(
+            metadata=assume_role(),
+            refresh_using=assume_role,
+            method="sts-assume-role"
         )
+        session = boto3.Session(botocore_session=botocore_session, region_name=target_region)
         if not silent:
             print(" ... successful!")
-        client_kwargs["aws_access_key_id"] = response["Credentials"]["AccessKeyId"]
-        client_kwargs["aws_secret_access_key"] = response["Credentials"]["SecretAccessKey"]
-        client_kwargs["aws_session_token"] = response["Credentials"]["SessionToken"]
 
     if runtime:
         service_name='bedrock-runtime'
@@ -91,6 +156,8 @@ def get_bedrock_client(
         config=retry_config,
         **client_kwargs
     )
+    if rate_limit and runtime:
+        register_rate_limiter(bedrock_client)
     if not silent:
         print("boto3 Bedrock client successfully created!")
         print(bedrock_client._endpoint)
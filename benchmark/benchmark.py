@@ -0,0 +1,239 @@
+#!/usr/bin/python3
+"""Offline benchmark for question_to_sql.py and embed.py.
+
+Runs the pipeline against the deterministic Bedrock and ClickHouse stand-ins in fakes.py, using the README example
+questions and the questions seeded in questions.sql, and reports per-stage latency percentiles, throughput at each
+concurrency level and LLM call counts. No AWS or ClickHouse access is required.
+"""
+import argparse
+import asyncio
+import collections
+import functools
+import io
+import json
+import os
+import re
+import runpy
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCHMARK_DIR)
+FIXTURES_DIR = os.path.join(BENCHMARK_DIR, "fixtures")
+sys.path.insert(0, ROOT_DIR)
+sys.path.insert(0, BENCHMARK_DIR)
+
+from fakes import FakeBedrock, FakeClickHouse  # noqa: E402
+from row_binary import encode_string, read_float32_array  # noqa: E402
+
+STAGES = ["extract_key_metrics", "identify_concept", "generate_embedding_vector", "nearest_example_questions",
+          "find_pages_for_concept", "page_phrases", "generate_sql", "generate_sql_stream", "estimate_sql"]
+
+
+def load_seed_questions():
+    """Reads the (question, query) pairs inserted into raw_questions by questions.sql, before the optional examples"""
+    with open(os.path.join(ROOT_DIR, "questions.sql")) as sql_file:
+        seeded = sql_file.read().split("-- optional:")[0]
+    return re.findall(r"\('([^']*)', \$\$(.*?)\$\$\)", seeded, re.DOTALL)
+
+
+def load_pages():
+    with open(os.path.join(FIXTURES_DIR, "site_pages.json")) as pages_file:
+        return [(page["url"], page["title"], page["content"]) for page in json.load(pages_file)]
+
+
+def load_schema():
+    """Reads the columns and sorting key of each table created by ga.sql, as system.columns would report them"""
+    with open(os.path.join(ROOT_DIR, "ga.sql")) as sql_file:
+        statements = re.findall(r"CREATE TABLE (?:\w+\.)?(\w+)\s*\((.*?)\n\)\s*ENGINE = [^\n]+\s*ORDER BY ([^\n]+)",
+                                sql_file.read(), re.DOTALL)
+    columns, sorting_keys = {}, {}
+    for table, definitions, order_by in statements:
+        for name, definition in re.findall(r"`(\w+)`\s+(.*?),?\n", definitions + "\n"):
+            cast = re.search(r"MATERIALIZED CAST\(.*'(\w+)'\)", definition)
+            column_type = cast.group(1) if cast else definition.split(" MATERIALIZED")[0]
+            columns.setdefault(table, []).append((name, column_type if column_type else "String"))
+        sorting_keys[table] = order_by.strip().strip("()")
+    return columns, sorting_keys
+
+
+def load_questions(path):
+    with open(path) as questions_file:
+        return [line.strip() for line in questions_file if line.strip()]
+
+
+def percentiles(values):
+    if not values:
+        return {"count": 0}
+    return {"count": len(values), "p50": float(np.percentile(values, 50)), "p90": float(np.percentile(values, 90)),
+            "p99": float(np.percentile(values, 99)), "max": float(max(values))}
+
+
+class StageTimer:
+    """Records the wall time of each call to the named module functions"""
+
+    def __init__(self, module, names):
+        self.lock = threading.Lock()
+        self.timings = collections.defaultdict(list)
+        for name in names:
+            setattr(module, name, self.wrap(name, getattr(module, name)))
+
+    def wrap(self, name, fn):
+        @functools.wraps(fn)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                with self.lock:
+                    self.timings[name].append(time.perf_counter() - start)
+        return timed
+
+    def reset(self):
+        with self.lock:
+            self.timings.clear()
+
+
+def benchmark_pipeline(args, bedrock, clickhouse):
+    import question_to_sql
+    question_to_sql._clients["bedrock"] = bedrock
+    question_to_sql._clients["clickhouse"] = clickhouse
+    timer = StageTimer(question_to_sql, STAGES)
+    questions = load_questions(args.questions) * args.repeat
+    results = []
+    for level in args.concurrency:
+        bedrock.reset()
+        clickhouse.reset()
+        timer.reset()
+        output = io.StringIO()
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=question_to_sql.concurrency) as executor:
+            asyncio.run(question_to_sql.answer_questions(questions, executor, output, batch_concurrency=level,
+                                                         stream=args.stream))
+        elapsed = time.perf_counter() - start
+        answers = [json.loads(line) for line in output.getvalue().splitlines()]
+        results.append({
+            "concurrency": level,
+            "questions": len(questions),
+            "errors": sum(1 for answer in answers if "error" in answer),
+            "seconds": elapsed,
+            "questions_per_second": len(questions) / elapsed,
+            "latency": percentiles([answer["seconds"] for answer in answers]),
+            "stages": {name: percentiles(timer.timings[name]) for name in STAGES},
+            "bedrock_calls_per_question": {model: calls / len(questions) for model, calls in bedrock.calls.items()},
+            "throttled": dict(bedrock.throttled),
+            "clickhouse_queries_per_question": {kind: count / len(questions)
+                                                for kind, count in clickhouse.queries.items()},
+        })
+    return results
+
+
+def encode_embed_chunk(rows, io_format):
+    """The chunk ClickHouse sends the embed UDF, in TabSeparated or RowBinary"""
+    header = f"{len(rows)}\n".encode("utf-8")
+    if io_format == "RowBinary":
+        return header + b"".join(encode_string(row) for row in rows)
+    return header + "".join(f"{row}\n" for row in rows).encode("utf-8")
+
+
+def count_embedded(output, io_format):
+    """Counts the non-empty embeddings written by the embed UDF"""
+    if io_format != "RowBinary":
+        return sum(1 for line in output.decode("utf-8").splitlines() if line != "[]")
+    embedded = 0
+    offset = 0
+    while offset < len(output):
+        embedding, offset = read_float32_array(output, offset)
+        embedded += 1 if embedding else 0
+    return embedded
+
+
+def benchmark_embed(args, bedrock):
+    import bedrock as bedrock_module
+    bedrock_module.get_bedrock_client = lambda **kwargs: bedrock
+    pages = load_pages()
+    rows = [pages[i % len(pages)][2] + f" {i}" for i in range(args.embed_rows)]
+    chunk = encode_embed_chunk(rows, args.embed_format)
+    results = []
+    for level in args.embed_concurrency:
+        bedrock.reset()
+        os.environ["EMBED_CONCURRENCY"] = str(level)
+        stdin, stdout, argv = sys.stdin, sys.stdout, sys.argv
+        sys.stdin, sys.stdout = io.TextIOWrapper(io.BytesIO(chunk)), io.TextIOWrapper(io.BytesIO())
+        sys.argv = ["embed.py", args.embed_format]
+        start = time.perf_counter()
+        try:
+            runpy.run_path(os.path.join(ROOT_DIR, "embed.py"), run_name="__main__")
+        finally:
+            sys.stdout.flush()
+            output = sys.stdout.buffer.getvalue()
+            sys.stdin, sys.stdout, sys.argv = stdin, stdout, argv
+        elapsed = time.perf_counter() - start
+        results.append({"concurrency": level, "format": args.embed_format, "rows": len(rows),
+                        "embedded": count_embedded(output, args.embed_format), "seconds": elapsed,
+                        "rows_per_second": len(rows) / elapsed, "bedrock_calls": sum(bedrock.calls.values())})
+    return results
+
+
+def print_report(report):
+    for result in report.get("pipeline", []):
+        print(f"pipeline concurrency={result['concurrency']} questions={result['questions']} "
+              f"errors={result['errors']} throughput={result['questions_per_second']:.2f} q/s")
+        latency = result["latency"]
+        print(f"  end to end        p50={latency['p50']:.3f}s p90={latency['p90']:.3f}s p99={latency['p99']:.3f}s")
+        for name, stage in result["stages"].items():
+            if stage["count"]:
+                print(f"  {name:<26} n={stage['count']:<5} p50={stage['p50']:.3f}s p90={stage['p90']:.3f}s "
+                      f"p99={stage['p99']:.3f}s")
+        for model, calls in result["bedrock_calls_per_question"].items():
+            print(f"  {model} calls/question={calls:.2f}")
+        for kind, queries in result["clickhouse_queries_per_question"].items():
+            print(f"  clickhouse {kind} queries/question={queries:.2f}")
+        if result["throttled"]:
+            print(f"  throttled={result['throttled']}")
+    for result in report.get("embed", []):
+        print(f"embed format={result['format']} concurrency={result['concurrency']} rows={result['rows']} embedded={result['embedded']} "
+              f"throughput={result['rows_per_second']:.1f} rows/s")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Offline benchmark of the RAG pipeline and embed UDF")
+    parser.add_argument("--questions", type=str, default=os.path.join(FIXTURES_DIR, "questions.txt"),
+                        help="File of questions, one per line")
+    parser.add_argument("--repeat", type=int, default=1, help="Number of times each question is asked")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4], help="Questions in flight")
+    parser.add_argument("--embed_rows", type=int, default=200, help="Rows in the embed UDF chunk, 0 to skip")
+    parser.add_argument("--embed_concurrency", type=int, nargs="+", default=[1, 8],
+                        help="EMBED_CONCURRENCY levels for the embed UDF")
+    parser.add_argument("--embed_format", type=str, default="RowBinary", choices=["RowBinary", "TabSeparated"],
+                        help="I/O format of the embed UDF")
+    parser.add_argument("--embedding_latency", type=float, default=0.05, help="Mean titan latency in seconds")
+    parser.add_argument("--completion_latency", type=float, default=0.5, help="Mean claude latency in seconds")
+    parser.add_argument("--clickhouse_latency", type=float, default=0.01, help="Mean query latency in seconds")
+    parser.add_argument("--throttle_rate", type=float, default=0.0,
+                        help="Fraction of Bedrock calls which raise ThrottlingException")
+    parser.add_argument("--stream", action="store_true", default=False,
+                        help="Generate SQL with the streaming response API")
+    parser.add_argument("--caches", action="store_true", default=False,
+                        help="Leave the embedding and phrase caches enabled")
+    parser.add_argument("--json", type=str, default=None, help="Also write the report as JSON to this file")
+    args = parser.parse_args()
+
+    if not args.caches:
+        os.environ["EMBEDDING_CACHE_ENABLED"] = "0"
+        os.environ["PHRASE_CACHE_ENABLED"] = "0"
+        os.environ["ANSWER_CACHE"] = "0"
+    bedrock = FakeBedrock(embedding_latency=args.embedding_latency, completion_latency=args.completion_latency,
+                          throttle_rate=args.throttle_rate)
+    clickhouse = FakeClickHouse(load_seed_questions(), load_pages(), schema=load_schema(),
+                                latency=args.clickhouse_latency)
+    report = {"pipeline": benchmark_pipeline(args, bedrock, clickhouse)}
+    if args.embed_rows:
+        report["embed"] = benchmark_embed(args, bedrock)
+    print_report(report)
+    if args.json:
+        with open(args.json, "w") as json_file:
+            json.dump(report, json_file, indent=2)
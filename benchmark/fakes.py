@@ -0,0 +1,252 @@
+"""Deterministic local stand-ins for the Bedrock runtime and ClickHouse clients used by the benchmark."""
+import array
+import collections
+import hashlib
+import io
+import json
+import random
+import re
+import struct
+import threading
+import time
+import numpy as np
+from botocore.exceptions import ClientError
+from row_binary import read_float32_array
+
+EMBEDDING_DIMENSIONS = 1536
+
+
+def fake_embedding(text):
+    """Deterministic unit vector for a text, so identical texts always embed identically"""
+    seed = int.from_bytes(hashlib.sha256(" ".join(text.split()).lower().encode("utf-8")).digest()[:8], "little")
+    vector = np.random.default_rng(seed).normal(size=EMBEDDING_DIMENSIONS).astype(np.float32)
+    return (vector / np.linalg.norm(vector)).tolist()
+
+
+class Latency:
+    """Latency in seconds drawn uniformly from [mean * (1 - jitter), mean * (1 + jitter)]"""
+
+    def __init__(self, mean, jitter=0.2, seed=0):
+        self.mean = mean
+        self.jitter = jitter
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def sleep(self):
+        if self.mean <= 0:
+            return
+        with self.lock:
+            delay = self.mean * self.random.uniform(1 - self.jitter, 1 + self.jitter)
+        time.sleep(delay)
+
+    def sleep_fraction(self, fraction):
+        if self.mean <= 0:
+            return
+        with self.lock:
+            delay = self.mean * fraction * self.random.uniform(1 - self.jitter, 1 + self.jitter)
+        time.sleep(delay)
+
+
+class FakeBedrock:
+    """Replays invoke_model responses for the titan embedding and claude models used by the pipeline.
+
+    Completions are chosen from the prompt so the pipeline exercises every stage. A fraction of calls, set by
+    throttle_rate, raise a ThrottlingException as Bedrock does when over quota.
+    """
+
+    def __init__(self, embedding_latency=0.05, completion_latency=1.0, throttle_rate=0.0, seed=0):
+        self.embedding_latency = Latency(embedding_latency, seed=seed)
+        self.completion_latency = Latency(completion_latency, seed=seed + 1)
+        self.throttle_rate = throttle_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = collections.Counter()
+        self.throttled = collections.Counter()
+
+    def reset(self):
+        with self.lock:
+            self.calls.clear()
+            self.throttled.clear()
+
+    def throttle(self, model_id):
+        with self.lock:
+            throttled = self.random.random() < self.throttle_rate
+            if throttled:
+                self.throttled[model_id] += 1
+        if throttled:
+            raise ClientError({"Error": {"Code": "ThrottlingException", "Message": "Rate exceeded"}}, "InvokeModel")
+
+    def completion(self, prompt):
+        if "extract the key metrics" in prompt:
+            question = prompt.rsplit("Extract the key metric from the following question:", 1)[-1]
+            question = question.split("Put each metric")[0]
+            metrics = [metric for metric in ("new users", "returning users", "active users", "total users",
+                                             "total sessions", "page views", "average views")
+                       if metric in question.lower()]
+            return "".join(f"<metric>{metric}</metric>" for metric in metrics or ["total users"])
+        if "text field to be searched" in prompt:
+            question = prompt.rsplit("Analyze the following question:", 1)[-1].split("Put the words")[0].strip()
+            match = re.search(r"(?:about|containing) ([\w\s]+?)(?:\?| over| since|$)", question)
+            return f"<words>{match.group(1).strip() if match else 'all_docs'}</words>"
+        if "Extract up to 3 keywords" in prompt:
+            concept = re.search(r'related to "([^"]*)"', prompt).group(1)
+            return "".join(f"<word>{word}</word>" for word in [concept] + concept.split()[:2])
+        return "<sql>SELECT count() FROM ga_daily</sql>\n\nThis query counts the events in ga_daily."
+
+    def completion_response(self, request):
+        completion = self.completion(request["prompt"])
+        for stop in request.get("stop_sequences", []):
+            if stop in completion:
+                return {"completion": completion[:completion.index(stop)], "stop_reason": "stop_sequence",
+                        "stop": stop}
+        return {"completion": completion, "stop_reason": "stop_sequence", "stop": None}
+
+    def invoke_model_with_response_stream(self, body, modelId, accept=None, contentType=None, **kwargs):
+        with self.lock:
+            self.calls[modelId] += 1
+        self.throttle(modelId)
+        response = self.completion_response(json.loads(body))
+        completion = response["completion"]
+        size = 8
+        chunks = [{"completion": completion[i:i + size], "stop_reason": None, "stop": None}
+                  for i in range(0, len(completion), size)] or [{"completion": ""}]
+        chunks[-1].update(stop_reason=response["stop_reason"], stop=response["stop"])
+        chunks[-1]["amazon-bedrock-invocationMetrics"] = {"inputTokenCount": len(body) // 4,
+                                                          "outputTokenCount": len(completion) // 4}
+        return {"body": FakeEventStream(chunks, self.completion_latency), "contentType": "application/json"}
+
+    def invoke_model(self, body, modelId, accept=None, contentType=None, **kwargs):
+        with self.lock:
+            self.calls[modelId] += 1
+        request = json.loads(body)
+        if "embed" in modelId:
+            self.embedding_latency.sleep()
+            self.throttle(modelId)
+            response = {"embedding": fake_embedding(request["inputText"]), "inputTextTokenCount": 0}
+        else:
+            self.completion_latency.sleep()
+            self.throttle(modelId)
+            response = self.completion_response(request)
+        # token counts are approximated from the text length
+        output = response.get("completion", "")
+        headers = {"x-amzn-bedrock-input-token-count": str(len(body) // 4),
+                   "x-amzn-bedrock-output-token-count": str(len(output) // 4)}
+        return {"body": io.BytesIO(json.dumps(response).encode("utf-8")), "contentType": "application/json",
+                "ResponseMetadata": {"HTTPHeaders": headers}}
+
+
+class FakeEventStream:
+    """Yields completion chunks in the shape of a Bedrock response stream, spreading the latency across them"""
+
+    def __init__(self, chunks, latency):
+        self.chunks = chunks
+        self.latency = latency
+        self.closed = False
+
+    def __iter__(self):
+        for chunk in self.chunks:
+            if self.closed:
+                return
+            self.latency.sleep_fraction(1 / len(self.chunks))
+            yield {"chunk": {"bytes": json.dumps(chunk).encode("utf-8")}}
+
+    def close(self):
+        self.closed = True
+
+
+class QueryResult:
+
+    def __init__(self, rows):
+        self.result_rows = rows
+
+
+def decode_targets(external_data):
+    """Decodes the (n UInt32, embedding Array(Float32)) RowBinary external table sent by question_to_sql"""
+    data = external_data.files[0].data
+    offset = 0
+    targets = []
+    while offset < len(data):
+        n = struct.unpack_from("<I", data, offset)[0]
+        embedding, offset = read_float32_array(data, offset + 4)
+        targets.append((n, array.array("f", embedding).tolist()))
+    return targets
+
+
+class FakeClickHouse:
+    """Answers the queries issued by question_to_sql.py from in-memory questions and site_pages tables"""
+
+    def __init__(self, questions, pages, schema=None, latency=0.01, seed=0):
+        self.latency = Latency(latency, seed=seed)
+        self.columns, self.sorting_keys = schema or ({}, {})
+        self.lock = threading.Lock()
+        self.queries = collections.Counter()
+        self.questions = [(question, query, fake_embedding(question)) for question, query in questions]
+        self.pages = [(url, title, content, fake_embedding(content)) for url, title, content in pages]
+        self.question_matrix = np.array([row[2] for row in self.questions], dtype=np.float32)
+        self.page_matrix = np.array([row[3] for row in self.pages], dtype=np.float32)
+
+    def reset(self):
+        with self.lock:
+            self.queries.clear()
+
+    def count(self, kind):
+        with self.lock:
+            self.queries[kind] += 1
+
+    def query(self, query, parameters=None, settings=None, external_data=None, **kwargs):
+        self.latency.sleep()
+        if "system.columns" in query:
+            self.count("schema")
+            return QueryResult([(table, name, column_type) for table in parameters["tables"]
+                                for name, column_type in self.columns.get(table, [])])
+        if "system.tables" in query:
+            self.count("schema")
+            return QueryResult([(table, self.sorting_keys[table]) for table in parameters["tables"]
+                                if table in self.sorting_keys])
+        if query.startswith("EXPLAIN ESTIMATE"):
+            self.count("explain")
+            return QueryResult([("default", "ga_daily", 4, 1000000, 123)])
+        if "data_compressed_bytes" in query:
+            self.count("explain")
+            return QueryResult([(table, 40.0) for table in parameters["tables"]])
+        if "system.parts" in query:
+            self.count("version")
+            return QueryResult([(len(self.questions), 0)])
+        if "FROM questions CROSS JOIN targets" in query:
+            self.count("questions")
+            rows = []
+            for n, target in decode_targets(external_data):
+                distances = np.linalg.norm(self.question_matrix - np.array(target, dtype=np.float32), axis=1)
+                nearest = self.questions[int(np.argmin(distances))]
+                rows.append((n, (nearest[0], nearest[1])))
+            return QueryResult(rows)
+        if "FROM questions" in query:
+            self.count("questions")
+            if "embedding" in query.split("FROM")[0]:
+                return QueryResult(self.questions)
+            target = json.loads(re.search(r"L2Distance\(embedding, (\[.*?\])\)", query).group(1))
+            distances = np.linalg.norm(self.question_matrix - np.array(target, dtype=np.float32), axis=1)
+            return QueryResult([self.questions[int(np.argmin(distances))][:2]])
+        if "FROM site_pages" in query:
+            self.count("site_pages")
+            if parameters and "embedding" in parameters:
+                target, limit = parameters["embedding"], parameters.get("limit", 3)
+            else:
+                target = json.loads(re.search(r"cosineDistance\(embedding, (\[.*?\])\)", query).group(1))
+                limit = int(re.search(r"LIMIT (\d+)", query).group(1))
+            similarities = self.page_matrix @ np.array(target, dtype=np.float32)
+            nearest = np.argsort(-similarities)[:limit]
+            return QueryResult([self.pages[i][:3] + (float(1 - similarities[i]),) for i in nearest]
+                               if parameters else [self.pages[i][:3] for i in nearest])
+        self.count("other")
+        return QueryResult([])
+
+    def command(self, command, parameters=None, settings=None, **kwargs):
+        self.latency.sleep()
+        self.count("command")
+        return None
+
+    def insert(self, table=None, data=None, column_names=None, database=None, **kwargs):
+        self.latency.sleep()
+        self.count("insert")
+        return None
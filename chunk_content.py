@@ -0,0 +1,44 @@
+#!/usr/bin/python3
+import json
+import os
+import sys
+import logging
+logging.basicConfig(filename='chunk.log', level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# chunks are kept under embed.py's char_limit so no text is truncated before embedding
+chunk_size = int(os.getenv("CHUNK_SIZE", default=2000))
+chunk_overlap = int(os.getenv("CHUNK_OVERLAP", default=200))
+
+
+def chunk_text(text, size=chunk_size, overlap=chunk_overlap):
+    """Yields overlapping chunks of at most size characters, breaking on whitespace where possible"""
+    text = text.strip()
+    start = 0
+    while start < len(text):
+        end = min(start + size, len(text))
+        if end < len(text):
+            boundary = text.rfind(" ", start + size // 2, end)
+            if boundary != -1:
+                end = boundary
+        chunk = text[start:end].strip()
+        if chunk:
+            yield chunk
+        if end >= len(text):
+            return
+        # start the next chunk on a word boundary within the overlap
+        next_start = max(end - overlap, start + 1)
+        boundary = text.find(" ", next_start, end)
+        start = boundary + 1 if boundary != -1 else next_start
+
+
+if __name__ == '__main__':
+    for size in sys.stdin:
+        # collect batch to process
+        for row in range(0, int(size)):
+            try:
+                content = json.loads(sys.stdin.readline())["content"]
+                print(json.dumps({"result": list(chunk_text(content))}))
+            except Exception as e:
+                logging.error(e)
+                print(json.dumps({"result": []}))
+        sys.stdout.flush()
@@ -1,42 +1,97 @@
 #!/usr/bin/python3
+import contextvars
 import json
+import os
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from bedrock import get_bedrock_client
+from embedding_cache import get_embedding_cache
+from row_binary import encode_embedding, read_strings
+import tracing
 from tenacity import (
     retry,
     stop_after_attempt,
     wait_random_exponential,
 )
+import numpy as np
 import logging
 logging.basicConfig(filename='embed.log', level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-# add assumed_role if required
-bedrock_runtime = get_bedrock_client(region="us-east-1", silent=True)
+# number of rows embedded concurrently within a chunk
+concurrency = int(os.getenv("EMBED_CONCURRENCY", default=8))
+
+# the UDF's format in bedrock_function.xml, passed as the command's argument: RowBinary or TabSeparated
+io_format = sys.argv[1] if len(sys.argv) > 1 else "TabSeparated"
+
+# add assumed_role if required. tenacity retries, so each retry is recorded on the span
+bedrock_runtime = get_bedrock_client(region="us-east-1", silent=True, max_pool_connections=concurrency,
+                                     rate_limit=True, max_attempts=1)
 accept = "application/json"
 contentType = "application/json"
 modelId = "amazon.titan-embed-text-v1"
 char_limit = 10000  # 1500 tokens effectively
+cache = get_embedding_cache()
 
 
-@retry(wait=wait_random_exponential(min=1, max=60), stop=stop_after_attempt(20))
+@retry(wait=wait_random_exponential(min=1, max=60), stop=stop_after_attempt(20), before_sleep=tracing.record_retry)
 def embeddings_with_backoff(**kwargs):
-    return bedrock_runtime.invoke_model(**kwargs)
-
-
-for size in sys.stdin:
-    # collect batch to process
-    for row in range(0, int(size)):
-        try:
-            text = sys.stdin.readline()
-            text = text[:char_limit]
-            body = json.dumps({"inputText": text})
-            response = embeddings_with_backoff(
-                body=body, modelId=modelId, accept=accept, contentType=contentType
-            )
-            response_body = json.loads(response.get("body").read())
-            embedding = response_body.get("embedding")
-            print(json.dumps(embedding))
-        except Exception as e:
-            logging.error(e)
-            print(json.dumps([]))
-    sys.stdout.flush()
+    response = bedrock_runtime.invoke_model(**kwargs)
+    tracing.record_bedrock(kwargs.get("body", ""), response)
+    return response
+
+
+def parse_embedding(response_body):
+    """Parses the embedding array of a titan response straight into little-endian float32 bytes"""
+    start = response_body.index(b"[", response_body.index(b'"embedding"')) + 1
+    end = response_body.index(b"]", start)
+    return np.fromstring(response_body[start:end], dtype="<f4", sep=",").tobytes()
+
+
+@tracing.traced("embed")
+def embed_text(text):
+    """Returns the embedding of the text as float32 bytes"""
+    text = text[:char_limit]
+    if cache is not None:
+        embedding = cache.get(modelId, text, raw=True)
+        if embedding is not None:
+            return embedding
+    body = json.dumps({"inputText": text})
+    response = embeddings_with_backoff(
+        body=body, modelId=modelId, accept=accept, contentType=contentType
+    )
+    embedding = parse_embedding(response.get("body").read())
+    if cache is not None:
+        cache.put(modelId, text, embedding)
+    return embedding
+
+
+def embed(text, context):
+    try:
+        # each row runs in its own copy of the chunk's context so its span is linked to the chunk
+        return context.copy().run(embed_text, text)
+    except Exception as e:
+        logging.error(e)
+        return b""
+
+
+def read_chunk(size):
+    return read_strings(sys.stdin.buffer, size, io_format)
+
+
+def write_embedding(embedding):
+    sys.stdout.buffer.write(encode_embedding(embedding, io_format))
+
+
+tracing.configure()
+
+# the chunk header is a text line in either format, read from the binary stream like the rows
+with ThreadPoolExecutor(max_workers=concurrency) as executor:
+    for size in sys.stdin.buffer:
+        with tracing.span("embed_chunk"):
+            # collect batch to process
+            texts = read_chunk(int(size))
+            context = contextvars.copy_context()
+            # map preserves input order so each row's embedding is written in its slot
+            for embedding in executor.map(lambda text: embed(text, context), texts):
+                write_embedding(embedding)
+            sys.stdout.buffer.flush()
@@ -0,0 +1,158 @@
+#!/usr/bin/python3
+"""Persistent, content-addressed cache for Bedrock embeddings.
+
+Embeddings are stored in a local SQLite database keyed by (model id, hash of the normalized text). The database
+runs in WAL mode so the ClickHouse `executable_pool` processes running embed.py, and question_to_sql.py, can share
+it safely. Least recently used entries are evicted once the stored embeddings exceed the configured size.
+
+Configured through the environment:
+    EMBEDDING_CACHE_ENABLED - set to 0 to disable the cache (default 1)
+    EMBEDDING_CACHE_PATH - location of the SQLite database (default embedding_cache.db)
+    EMBEDDING_CACHE_MAX_MB - maximum size of stored embeddings before eviction (default 1024)
+
+Run this module directly to print hit/miss counters for the cache.
+"""
+import array
+import hashlib
+import logging
+import os
+import sqlite3
+import time
+from sqlite_cache import SQLiteCache, print_stats
+
+EVICTION_CHECK_INTERVAL = 100
+
+
+def normalize(text):
+    return " ".join(text.split())
+
+
+def cache_key(model_id, text):
+    return hashlib.sha256(f"{model_id}\0{normalize(text)}".encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache(SQLiteCache):
+
+    def __init__(self, path="embedding_cache.db", max_bytes=1024 * 1024 * 1024):
+        super().__init__(path)
+        self.max_bytes = max_bytes
+        self._puts = 0
+        with self._connection() as conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS embeddings (
+                key TEXT PRIMARY KEY,
+                model_id TEXT NOT NULL,
+                embedding BLOB NOT NULL,
+                chars INTEGER NOT NULL,
+                accessed REAL NOT NULL)""")
+            conn.execute("CREATE INDEX IF NOT EXISTS embeddings_accessed ON embeddings (accessed)")
+            conn.execute("""CREATE TABLE IF NOT EXISTS stats (
+                name TEXT PRIMARY KEY,
+                value INTEGER NOT NULL)""")
+
+    def _increment(self, conn, name, value=1):
+        conn.execute("INSERT INTO stats (name, value) VALUES (?, ?) "
+                     "ON CONFLICT(name) DO UPDATE SET value = value + excluded.value", (name, value))
+
+    def get(self, model_id, text, raw=False):
+        """Returns the cached embedding as a list, or as float32 bytes if raw, or None on a miss. Errors reading the
+        database are logged and treated as a miss, as the cache is only an optimisation."""
+        try:
+            return self._get(model_id, text, raw)
+        except sqlite3.Error as e:
+            logging.warning(f"embedding cache get failed: {e}")
+            self._record(hit=False)
+            return None
+
+    def _get(self, model_id, text, raw):
+        key = cache_key(model_id, text)
+        with self._connection() as conn:
+            row = conn.execute("SELECT embedding, chars FROM embeddings WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self._record(hit=False)
+                self._increment(conn, "misses")
+                return None
+            conn.execute("UPDATE embeddings SET accessed = ? WHERE key = ?", (time.time(), key))
+            self._increment(conn, "hits")
+            self._increment(conn, "saved_chars", row[1])
+        self._record(hit=True)
+        return bytes(row[0]) if raw else array.array("f", row[0]).tolist()
+
+    def put(self, model_id, text, embedding):
+        """Stores the embedding, logging rather than raising errors writing the database"""
+        try:
+            self._put(model_id, text, embedding)
+        except sqlite3.Error as e:
+            logging.warning(f"embedding cache put failed: {e}")
+
+    def _put(self, model_id, text, embedding):
+        if not embedding:
+            return
+        key = cache_key(model_id, text)
+        # embeddings may already be float32 bytes
+        blob = embedding if isinstance(embedding, bytes) else array.array("f", embedding).tobytes()
+        with self._connection() as conn:
+            conn.execute("INSERT OR REPLACE INTO embeddings (key, model_id, embedding, chars, accessed) "
+                         "VALUES (?, ?, ?, ?, ?)", (key, model_id, blob, len(text), time.time()))
+        with self._lock:
+            self._puts += 1
+            check = self._puts % EVICTION_CHECK_INTERVAL == 1
+        if check:
+            self.evict()
+
+    def evict(self):
+        with self._connection() as conn:
+            size = conn.execute("SELECT COALESCE(SUM(length(embedding)), 0) FROM embeddings").fetchone()[0]
+            if size <= self.max_bytes:
+                return
+            # drop least recently used entries until we are 10% below the limit
+            excess = size - int(self.max_bytes * 0.9)
+            rows = conn.execute("SELECT key, length(embedding) FROM embeddings ORDER BY accessed ASC")
+            keys = []
+            for key, length in rows:
+                if excess <= 0:
+                    break
+                keys.append((key,))
+                excess -= length
+            conn.executemany("DELETE FROM embeddings WHERE key = ?", keys)
+            self._increment(conn, "evictions", len(keys))
+
+    def stats(self):
+        conn = self._connection()
+        totals = dict(conn.execute("SELECT name, value FROM stats").fetchall())
+        entries, size = conn.execute("SELECT count(), COALESCE(SUM(length(embedding)), 0) FROM embeddings").fetchone()
+        return {
+            "process_hits": self.hits,
+            "process_misses": self.misses,
+            "hits": totals.get("hits", 0),
+            "misses": totals.get("misses", 0),
+            "evictions": totals.get("evictions", 0),
+            "saved_bedrock_calls": totals.get("hits", 0),
+            "saved_input_chars": totals.get("saved_chars", 0),
+            "entries": entries,
+            "bytes": size,
+        }
+
+
+_cache = None
+_failed = False
+
+
+def get_embedding_cache():
+    """Returns the process wide cache configured from the environment, or None if disabled or the database can't be
+    opened"""
+    global _cache, _failed
+    if os.getenv("EMBEDDING_CACHE_ENABLED", default="1") == "0" or _failed:
+        return None
+    if _cache is None:
+        try:
+            _cache = EmbeddingCache(path=os.getenv("EMBEDDING_CACHE_PATH", default="embedding_cache.db"),
+                                    max_bytes=int(os.getenv("EMBEDDING_CACHE_MAX_MB", default=1024)) * 1024 * 1024)
+        except sqlite3.Error as e:
+            # embed without the cache for the rest of the process
+            logging.warning(f"embedding cache disabled: {e}")
+            _failed = True
+    return _cache
+
+
+if __name__ == '__main__':
+    print_stats(get_embedding_cache(), "embedding cache is disabled")
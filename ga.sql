@@ -30,6 +30,67 @@ ENGINE = MergeTree
 ORDER BY (event_timestamp, event_name, ga_session_id)
 
 
+-- optional: daily rollup of the canonical metrics by event name and page, maintained by a materialized view. Columns
+-- hold mergeable aggregate states, so questions at a daily, event or page grain (or coarser) read the rollup with
+-- uniqMerge/uniqExactMerge and sum rather than scanning raw events.
+--   total users - uniqMerge(users) WHERE event_name = 'session_start'
+--   active users - uniqMerge(active_users) WHERE event_name IN ('session_start', 'first_visit')
+--   new users - sum(events) WHERE event_name = 'first_visit'
+--   returning users - uniqExactMerge(returning_users) WHERE event_name = 'session_start'
+--   total sessions - uniqExactMerge(sessions)
+--   page views - sum(events) WHERE event_name = 'page_view'
+-- Then run the optional section of questions.sql so the example questions read the rollup.
+
+CREATE TABLE ga_daily_rollup
+(
+	`event_date` Date,
+	`event_name` String,
+	`page_location` String,
+	`events` SimpleAggregateFunction(sum, UInt64),
+	`users` AggregateFunction(uniq, Nullable(String)),
+	`active_users` AggregateFunction(uniq, Nullable(String)),
+	`returning_users` AggregateFunction(uniqExact, Nullable(String)),
+	`sessions` AggregateFunction(uniqExact, String, String, Nullable(String))
+)
+ENGINE = AggregatingMergeTree
+ORDER BY (event_date, event_name, page_location)
+
+
+-- the view only rolls up events on or after a cutoff date, and the backfill below covers the events before it, so no
+-- event is counted twice. The cutoff is a required query parameter, which must be after the last event already
+-- loaded e.g. tomorrow: clickhouse-client --param_cutoff=2024-06-01. Both statements fail if it isn't set.
+
+CREATE MATERIALIZED VIEW ga_daily_rollup_mv TO ga_daily_rollup AS
+SELECT
+	event_date,
+	event_name,
+	page_location,
+	count() AS events,
+	uniqState(user_pseudo_id) AS users,
+	uniqIfState(user_pseudo_id, ifNull(is_active_user, false) OR event_name = 'first_visit') AS active_users,
+	uniqExactIfState(user_pseudo_id, ifNull(is_active_user, false) AND (ga_session_number > 1 OR user_first_touch_timestamp < event_date)) AS returning_users,
+	uniqExactState(ga_session_id, '_', user_pseudo_id) AS sessions
+FROM ga_daily
+WHERE event_date >= {cutoff:Date}
+GROUP BY event_date, event_name, page_location
+
+
+-- backfill the rollup with the events before the cutoff. Run this once every event before the cutoff is loaded
+
+INSERT INTO ga_daily_rollup SELECT
+	event_date,
+	event_name,
+	page_location,
+	count() AS events,
+	uniqState(user_pseudo_id) AS users,
+	uniqIfState(user_pseudo_id, ifNull(is_active_user, false) OR event_name = 'first_visit') AS active_users,
+	uniqExactIfState(user_pseudo_id, ifNull(is_active_user, false) AND (ga_session_number > 1 OR user_first_touch_timestamp < event_date)) AS returning_users,
+	uniqExactState(ga_session_id, '_', user_pseudo_id) AS sessions
+FROM ga_daily
+WHERE event_date < {cutoff:Date}
+GROUP BY event_date, event_name, page_location
+
+
 -- assumes you have site_pages_raw created by a spider and the embed function.
 
 CREATE TABLE site_pages_raw
@@ -37,21 +98,107 @@ CREATE TABLE site_pages_raw
     `url` String,
     `raw_title` String,
     `raw_content` String,
+    `content_hash` String,
+    `etag` String,
+    `last_modified` String,
+    `lastmod` String,
+    `deleted` UInt8,
      `title` String MATERIALIZED extractTextFromHTML(raw_title),
     `content` String MATERIALIZED extractTextFromHTML(raw_content),
     `date` DateTime MATERIALIZED now()
 )
+ENGINE = ReplacingMergeTree(date)
 ORDER BY url
 
 
 CREATE TABLE site_pages
 (
     `url` String,
-     `title` String MATERIALIZED extractTextFromHTML(raw_title),
-    `content` String MATERIALIZED extractTextFromHTML(raw_content),
-    `date` DateTime MATERIALIZED now()
+    `title` String,
+    `content` String,
+    `content_hash` String,
+    `embedding` Array(Float32)
 )
+ENGINE = MergeTree
 ORDER BY url
 
 
-INSERT INTO pages SELECT url, title, content, embed(content) as embedding FROM site_pages_raw SETTINGS  merge_tree_min_rows_for_concurrent_read = 1, merge_tree_min_bytes_for_concurrent_read=0, min_insert_block_size_rows=10, min_insert_block_size_bytes=0
\ No newline at end of file
+-- pages whose embedding failed (embed returns []) are left out, so they are retried by the next incremental refresh
+
+INSERT INTO site_pages SELECT * FROM (SELECT url, title, content, content_hash, embed(content) as embedding FROM site_pages_raw FINAL WHERE deleted = 0) WHERE length(embedding) = 1536 SETTINGS  merge_tree_min_rows_for_concurrent_read = 1, merge_tree_min_bytes_for_concurrent_read=0, min_insert_block_size_rows=10, min_insert_block_size_bytes=0
+
+
+-- incremental refresh after a crawl with -a incremental=true. Pages which changed or were deleted are removed,
+-- then only new or changed pages are embedded.
+
+DELETE FROM site_pages WHERE (url, content_hash) NOT IN (SELECT url, content_hash FROM site_pages_raw FINAL WHERE deleted = 0)
+
+INSERT INTO site_pages SELECT * FROM (SELECT url, title, content, content_hash, embed(content) as embedding FROM site_pages_raw FINAL WHERE deleted = 0 AND (url, content_hash) NOT IN (SELECT url, content_hash FROM site_pages)) WHERE length(embedding) = 1536 SETTINGS  merge_tree_min_rows_for_concurrent_read = 1, merge_tree_min_bytes_for_concurrent_read=0, min_insert_block_size_rows=10, min_insert_block_size_bytes=0
+
+-- optional: ngram bloom filter over the lowercased page content for the filters generated by question_to_sql.py
+-- (CONTENT_FILTER=index), so multiSearchAny(lowerUTF8(content), [...]) only reads granules containing every 4-gram of
+-- a phrase. Phrases shorter than 4 characters can't be pruned. Pages are large, so the index is most selective when
+-- site_pages is created with a small granule e.g. SETTINGS index_granularity = 32
+
+ALTER TABLE site_pages ADD INDEX content_ngrams lowerUTF8(content) TYPE ngrambf_v1(4, 262144, 2, 0) GRANULARITY 1
+
+ALTER TABLE site_pages MATERIALIZE INDEX content_ngrams
+
+
+-- optional: chunk level embeddings, used when PAGE_RETRIEVAL=chunks. Pages are split into overlapping chunks by the
+-- chunk UDF (chunk_content.py) so long pages are embedded in full rather than truncated, and only the best matching
+-- chunk of each page is sent to the model.
+
+CREATE TABLE site_page_chunks
+(
+    `url` String,
+    `title` String,
+    `chunk_number` UInt32,
+    `chunk` String,
+    `content_hash` String,
+    `embedding` Array(Float32)
+)
+ENGINE = MergeTree
+ORDER BY (url, chunk_number)
+
+
+INSERT INTO site_page_chunks SELECT url, title, chunk_number, chunk, content_hash, embed(chunk) as embedding
+FROM (SELECT url, title, content_hash, chunk(content) AS chunks FROM site_pages_raw FINAL WHERE deleted = 0)
+ARRAY JOIN chunks AS chunk, arrayEnumerate(chunks) AS chunk_number
+SETTINGS  merge_tree_min_rows_for_concurrent_read = 1, merge_tree_min_bytes_for_concurrent_read=0, min_insert_block_size_rows=10, min_insert_block_size_bytes=0
+
+
+-- incremental refresh of the chunks, as for site_pages above
+
+DELETE FROM site_page_chunks WHERE (url, content_hash) NOT IN (SELECT url, content_hash FROM site_pages_raw FINAL WHERE deleted = 0)
+
+INSERT INTO site_page_chunks SELECT url, title, chunk_number, chunk, content_hash, embed(chunk) as embedding
+FROM (SELECT url, title, content_hash, chunk(content) AS chunks FROM site_pages_raw FINAL WHERE deleted = 0 AND (url, content_hash) NOT IN (SELECT url, content_hash FROM site_page_chunks))
+ARRAY JOIN chunks AS chunk, arrayEnumerate(chunks) AS chunk_number
+SETTINGS  merge_tree_min_rows_for_concurrent_read = 1, merge_tree_min_bytes_for_concurrent_read=0, min_insert_block_size_rows=10, min_insert_block_size_bytes=0
+
+
+-- optional: compact BFloat16 copies of the embeddings, used when COMPACT_EMBEDDINGS=1. The nearest candidates are
+-- found reading half the bytes of the full embeddings, then re-ranked with the full precision embedding of only
+-- those rows. The copies are derived from the embed output on insert, so embed is called once per row.
+
+SET allow_experimental_bfloat16_type = 1
+
+ALTER TABLE site_pages ADD COLUMN embedding_bf16 Array(BFloat16) MATERIALIZED CAST(embedding, 'Array(BFloat16)')
+
+ALTER TABLE site_pages MATERIALIZE COLUMN embedding_bf16
+
+ALTER TABLE site_page_chunks ADD COLUMN embedding_bf16 Array(BFloat16) MATERIALIZED CAST(embedding, 'Array(BFloat16)')
+
+ALTER TABLE site_page_chunks MATERIALIZE COLUMN embedding_bf16
+
+
+-- optional: approximate nearest neighbour search over the page embeddings, used when PAGE_SEARCH=ann.
+-- requires every embedding to have 1536 dimensions. The inserts above only keep those, but tables filled before then
+-- may need rows where embed returned [] removed first e.g. DELETE FROM site_pages WHERE length(embedding) != 1536
+
+SET allow_experimental_vector_similarity_index = 1
+
+ALTER TABLE site_pages ADD INDEX embedding_idx embedding TYPE vector_similarity('hnsw', 'cosineDistance', 1536) GRANULARITY 100000000
+
+ALTER TABLE site_pages MATERIALIZE INDEX embedding_idx
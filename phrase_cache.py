@@ -0,0 +1,76 @@
+#!/usr/bin/python3
+"""Persistent memo of the keywords extracted from a page for a concept.
+
+Keyword extraction with temperature 0 is deterministic for a page's content, concept and model, so results are
+stored in a local SQLite database keyed by page url, concept and model id along with a hash of the page content.
+A lookup only hits when the hash matches the current content, and storing the result for re-crawled content
+replaces the stale entry.
+
+Configured through the environment:
+    PHRASE_CACHE_ENABLED - set to 0 to disable the cache (default 1)
+    PHRASE_CACHE_PATH - location of the SQLite database (default phrase_cache.db)
+
+Run this module directly to print hit/miss counters for the cache.
+"""
+import hashlib
+import json
+import os
+from sqlite_cache import SQLiteCache, print_stats
+
+
+def content_hash(content):
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+class PhraseCache(SQLiteCache):
+
+    def __init__(self, path="phrase_cache.db"):
+        super().__init__(path)
+        with self._connection() as conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS phrases (
+                url TEXT NOT NULL,
+                concept TEXT NOT NULL,
+                model_id TEXT NOT NULL,
+                content_hash TEXT NOT NULL,
+                phrases TEXT NOT NULL,
+                PRIMARY KEY (url, concept, model_id))""")
+
+    def get(self, url, content, concept, model_id):
+        row = self._connection().execute(
+            "SELECT phrases FROM phrases WHERE url = ? AND concept = ? AND model_id = ? AND content_hash = ?",
+            (url, concept.strip().lower(), model_id, content_hash(content))).fetchone()
+        self._record(hit=row is not None)
+        return json.loads(row[0]) if row is not None else None
+
+    def put(self, url, content, concept, model_id, phrases):
+        with self._connection() as conn:
+            conn.execute("INSERT OR REPLACE INTO phrases (url, concept, model_id, content_hash, phrases) "
+                         "VALUES (?, ?, ?, ?, ?)",
+                         (url, concept.strip().lower(), model_id, content_hash(content), json.dumps(phrases)))
+
+    def stats(self):
+        conn = self._connection()
+        return {
+            "process_hits": self.hits,
+            "process_misses": self.misses,
+            "entries": conn.execute("SELECT count() FROM phrases").fetchone()[0],
+            "pages": conn.execute("SELECT count(DISTINCT url) FROM phrases").fetchone()[0],
+            "concepts": conn.execute("SELECT count(DISTINCT concept) FROM phrases").fetchone()[0],
+        }
+
+
+_cache = None
+
+
+def get_phrase_cache():
+    """Returns the process wide cache configured from the environment, or None if disabled"""
+    global _cache
+    if os.getenv("PHRASE_CACHE_ENABLED", default="1") == "0":
+        return None
+    if _cache is None:
+        _cache = PhraseCache(path=os.getenv("PHRASE_CACHE_PATH", default="phrase_cache.db"))
+    return _cache
+
+
+if __name__ == '__main__':
+    print_stats(get_phrase_cache(), "phrase cache is disabled")
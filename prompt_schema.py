@@ -0,0 +1,146 @@
+"""Schema and token budget for the SQL generation prompt.
+
+The table schemas are read from ClickHouse system.columns, so they always match the tables created by ga.sql, and
+cached for SCHEMA_REFRESH_SECONDS. Each prompt includes only the core columns of a table plus those whose name, or
+the name of one of their tuple elements, matches a word of the question, key metrics or concept. Examples are then
+added in rank order until the prompt reaches its token budget, so the lowest-ranked examples are dropped first.
+If the schema can't be read, the last one read is kept, or the hand-written schema is used until the next refresh.
+
+Configured through the environment:
+    PROMPT_SCHEMA - "pruned" to read and prune the schema (default) or "static" for the hand-written schema
+    PROMPT_TOKEN_BUDGET - approximate maximum prompt tokens, 0 for no limit (default 3000)
+    SCHEMA_REFRESH_SECONDS - how long the schema read from system.columns is cached (default 300)
+"""
+import logging
+import math
+import re
+import threading
+import time
+
+TABLES = ["ga_daily", "ga_daily_rollup", "site_pages"]
+
+# columns the rules refer to, always included in the schema
+CORE_COLUMNS = {
+    "ga_daily": ["event_date", "event_timestamp", "event_name", "ga_session_id", "ga_session_number",
+                 "page_location", "page_title", "user_pseudo_id", "user_first_touch_timestamp", "is_active_user"],
+    "ga_daily_rollup": ["event_date", "event_name", "page_location", "events", "users", "active_users",
+                        "returning_users", "sessions"],
+    "site_pages": ["url", "title", "content"],
+}
+
+# words too common in questions to indicate a column
+STOP_WORDS = {"the", "and", "for", "from", "with", "per", "how", "many", "much", "what", "which", "who", "are",
+              "was", "were", "did", "does", "over", "since", "last", "this", "that", "name", "number", "total",
+              "count", "all", "each", "top", "new", "day", "days", "week", "month", "year", "about", "containing"}
+
+# Claude averages roughly 3.5 characters per token for English and SQL
+CHARS_PER_TOKEN = 3.5
+
+
+def estimate_tokens(text):
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+def words(terms):
+    found = set()
+    for term in terms:
+        for word in re.findall(r"[a-z0-9]+", (term or "").lower()):
+            if len(word) >= 3 and word not in STOP_WORDS:
+                found.add(word)
+                # plurals e.g. "countries" or "browsers"
+                found.add(re.sub(r"(ies|s)$", lambda m: "y" if m.group(1) == "ies" else "", word))
+    return found
+
+
+def name_parts(column_type, name):
+    """The words of a column's name and, for tuples, the names of its elements"""
+    parts = set(name.lower().split("_"))
+    if column_type.startswith("Tuple("):
+        for element in re.findall(r"[(,]\s*(\w+) ", column_type):
+            parts.update(element.lower().split("_"))
+    return parts
+
+
+class SchemaCache:
+    """Columns and sorting keys of the prompt tables, re-read from ClickHouse after refresh_interval seconds"""
+
+    def __init__(self, query, tables=None, refresh_interval=300):
+        self.query = query
+        self.tables = tables or TABLES
+        self.refresh_interval = refresh_interval
+        self.lock = threading.Lock()
+        self.loaded = None
+        self.columns = {}
+        self.sorting_keys = {}
+
+    def refresh(self):
+        with self.lock:
+            if self.loaded is not None and time.monotonic() - self.loaded < self.refresh_interval:
+                return self.columns, self.sorting_keys
+            try:
+                columns = {}
+                for table, name, column_type in self.query(
+                        "SELECT table, name, type FROM system.columns WHERE database = currentDatabase() "
+                        "AND table IN {tables:Array(String)} ORDER BY table, position",
+                        parameters={"tables": self.tables}).result_rows:
+                    columns.setdefault(table, []).append((name, column_type))
+                sorting_keys = {table: sorting_key for table, sorting_key in self.query(
+                    "SELECT name, sorting_key FROM system.tables "
+                    "WHERE database = currentDatabase() AND name IN {tables:Array(String)}",
+                    parameters={"tables": self.tables}).result_rows}
+            except Exception as e:
+                # keep the last schema read, or none so the static schema is used, until the next refresh
+                logging.warning(f"prompt schema refresh failed: {e}")
+                self.loaded = time.monotonic()
+                return self.columns, self.sorting_keys
+            self.columns, self.sorting_keys, self.loaded = columns, sorting_keys, time.monotonic()
+            return columns, sorting_keys
+
+    def relevant_columns(self, table, terms):
+        """The core columns of the table plus those matching a word of the terms, in table order"""
+        columns, _ = self.refresh()
+        matches = words(terms)
+        core = CORE_COLUMNS.get(table, [])
+        return [(name, column_type) for name, column_type in columns.get(table, [])
+                if name in core or name_parts(column_type, name) & matches]
+
+    def render(self, terms):
+        """CREATE TABLE statements for the relevant columns of each table and the names of the columns omitted.
+        The statements are None if none of the tables were found."""
+        columns, sorting_keys = self.refresh()
+        schemas = []
+        omitted = set()
+        for table in self.tables:
+            relevant = self.relevant_columns(table, terms)
+            omitted.update(name for name, column_type in columns.get(table, []) if (name, column_type) not in relevant)
+            if not relevant:
+                continue
+            definitions = ",\n".join(f"    `{name}` {column_type}" for name, column_type in relevant)
+            order_by = f"\nORDER BY ({sorting_keys[table]})" if sorting_keys.get(table) else ""
+            schemas.append(f"<schema>\nCREATE TABLE {table}\n(\n{definitions}\n){order_by}\n</schema>")
+        return ("\n\n".join(schemas) if schemas else None), omitted
+
+
+def prune_rules(rules, omitted):
+    """Drops the rule lines describing columns omitted from the schema"""
+    kept = []
+    for line in rules.splitlines():
+        match = re.match(r"\s*- (\w+)", line)
+        if match is None or match.group(1) not in omitted:
+            kept.append(line)
+    return "\n".join(kept)
+
+
+def fit_examples(examples, fixed_tokens, budget):
+    """The highest-ranked examples which fit within the budget alongside fixed_tokens, keeping their order"""
+    if budget <= 0:
+        return examples
+    kept = []
+    used = fixed_tokens
+    for example in examples:
+        tokens = estimate_tokens(example) + 1
+        if used + tokens > budget:
+            break
+        kept.append(example)
+        used += tokens
+    return kept
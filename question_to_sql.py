@@ -1,61 +1,310 @@
 #!/usr/bin/python3
+import asyncio
+import contextvars
 import json
+import logging
 import os
 import re
 import sys
 import argparse
+import array
+import struct
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from bs4 import BeautifulSoup
 from tenacity import wait_random_exponential, stop_after_attempt, retry
 from bedrock import get_bedrock_client
+from answer_cache import get_answer_cache
+from embedding_cache import get_embedding_cache
+import tracing
+from phrase_cache import get_phrase_cache
+from row_binary import encode_float32_array
+from prompt_schema import SchemaCache, estimate_tokens, fit_examples, prune_rules
+from vector_index import VectorIndex
 import clickhouse_connect
-
-clickhouse_client = clickhouse_connect.get_client(host=os.getenv('CLICKHOUSE_HOST', default='localhost'),
-                                                  username=os.getenv('CLICKHOUSE_USERNAME', default='default'),
-                                                  password=os.getenv('CLICKHOUSE_PASSWORD', default=''))
-
-client = get_bedrock_client(region=os.getenv('AWS_REGION', default='us-east-1'), silent=True, runtime=True,
-                            assumed_role=os.getenv('AWS_ROLE', None))
+from clickhouse_connect import common
+from clickhouse_connect.driver import httputil
+from clickhouse_connect.driver.exceptions import DatabaseError, OperationalError
+from clickhouse_connect.driver.external import ExternalData
+
+# maximum number of Bedrock and ClickHouse calls in flight at once
+concurrency = int(os.getenv('PIPELINE_CONCURRENCY', default=8))
+
+# "exact" scans every site_pages embedding, "ann" uses the vector similarity index
+page_search = os.getenv('PAGE_SEARCH', default='exact')
+page_search_candidates = int(os.getenv('PAGE_SEARCH_CANDIDATES', default=256))
+
+# search the compact BFloat16 embedding columns (see ga.sql and questions.sql) for RERANK_CANDIDATES candidates, then
+# re-rank only those with the full precision embeddings
+compact_embeddings = os.getenv('COMPACT_EMBEDDINGS', default='0') == '1'
+rerank_candidates = int(os.getenv('RERANK_CANDIDATES', default=50))
+
+# "pages" matches whole pages in site_pages, "chunks" matches page chunks in site_page_chunks
+page_retrieval = os.getenv('PAGE_RETRIEVAL', default='pages')
+
+# optionally check generated SQL with EXPLAIN ESTIMATE, regenerating once if it fails or would read more than
+# SQL_MAX_ESTIMATED_ROWS rows or SQL_MAX_ESTIMATED_BYTES bytes (0 for no limit)
+sql_validation = os.getenv('SQL_VALIDATION', default='0') == '1'
+sql_max_estimated_rows = int(os.getenv('SQL_MAX_ESTIMATED_ROWS', default=0))
+sql_max_estimated_bytes = int(os.getenv('SQL_MAX_ESTIMATED_BYTES', default=0))
+# optional settings added to the returned SQL to bound its execution
+sql_settings = {name: int(os.getenv(env)) for name, env in (("max_execution_time", "SQL_MAX_EXECUTION_TIME"),
+                                                            ("max_rows_to_read", "SQL_MAX_ROWS_TO_READ"))
+                if os.getenv(env)}
+
+# "index" filters pages with multiSearchAny, which can use the content_ngrams skip index in ga.sql to prune granules
+# for phrases of at least 4 characters, "ilike" with ILIKE
+content_filter = os.getenv('CONTENT_FILTER', default='index')
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_clickhouse_client():
+    """Returns the shared ClickHouse client, created on first use"""
+    with _clients_lock:
+        if "clickhouse" not in _clients:
+            # queries are issued concurrently so they can't share a ClickHouse session
+            common.set_setting('autogenerate_session_id', False)
+            _clients["clickhouse"] = clickhouse_connect.get_client(
+                host=os.getenv('CLICKHOUSE_HOST', default='localhost'),
+                username=os.getenv('CLICKHOUSE_USERNAME', default='default'),
+                password=os.getenv('CLICKHOUSE_PASSWORD', default=''),
+                pool_mgr=httputil.get_pool_manager(maxsize=concurrency))
+        return _clients["clickhouse"]
+
+
+def get_client():
+    """Returns the shared Bedrock runtime client, created on first use. Assumed role credentials refresh
+    automatically before they expire."""
+    with _clients_lock:
+        if "bedrock" not in _clients:
+            _clients["bedrock"] = get_bedrock_client(region=os.getenv('AWS_REGION', default='us-east-1'), silent=True,
+                                                     runtime=True, assumed_role=os.getenv('AWS_ROLE', None),
+                                                     max_pool_connections=concurrency, rate_limit=True,
+                                                     # tenacity retries, so each retry is recorded on the span
+                                                     max_attempts=1)
+        return _clients["bedrock"]
+
+
+tracing.configure(client_factory=get_clickhouse_client)
 
 accept = "application/json"
 contentType = "application/json"
 
 
-@retry(wait=wait_random_exponential(min=1, max=60), stop=stop_after_attempt(20))
+@retry(wait=wait_random_exponential(min=1, max=60), stop=stop_after_attempt(20), before_sleep=tracing.record_retry)
 def bedrock_with_backoff(**kwargs):
-    return client.invoke_model(**kwargs)
+    response = get_client().invoke_model(**kwargs)
+    tracing.record_bedrock(kwargs.get("body", ""), response)
+    return response
 
 
-def generate_embedding(text):
+def clickhouse_query(*args, **kwargs):
+    result = get_clickhouse_client().query(*args, **kwargs)
+    tracing.record_query(result)
+    return result
+
+
+@tracing.traced("generate_embedding")
+def generate_embedding_vector(text):
+    model_id = "amazon.titan-embed-text-v1"
+    cache = get_embedding_cache()
+    if cache is not None:
+        embedding = cache.get(model_id, text)
+        if embedding is not None:
+            return embedding
     body = json.dumps({"inputText": text.strip()})
     response = bedrock_with_backoff(
-        body=body, modelId="amazon.titan-embed-text-v1", accept=accept, contentType=contentType
+        body=body, modelId=model_id, accept=accept, contentType=contentType
     )
     response_body = json.loads(response.get("body").read())
     embedding = response_body.get("embedding")
-    return json.dumps(embedding)
+    if cache is not None:
+        cache.put(model_id, text, embedding)
+    return embedding
 
 
-def find_example_questions_for_metrics(metrics):
+def generate_embedding(text):
+    return json.dumps(generate_embedding_vector(text))
+
+
+def embeddings_external_data(embeddings, name="targets"):
+    """Encodes embeddings as a RowBinary external table (n UInt32, embedding Array(Float32)) numbered from 1"""
+    data = bytearray()
+    for n, embedding in enumerate(embeddings, start=1):
+        data += struct.pack("<I", n)
+        data += encode_float32_array(array.array("f", embedding).tobytes())
+    return ExternalData(data=bytes(data), file_name=name, fmt="RowBinary",
+                        structure=["n UInt32", "embedding Array(Float32)"])
+
+
+class QuestionIndex:
+    """In-memory copy of the questions table for local nearest neighbour search.
+
+    The table version (row count and latest part modification time) is checked at most every
+    refresh_interval seconds and the embeddings are only reloaded when it has changed.
+    """
+
+    def __init__(self, refresh_interval=60):
+        self.refresh_interval = refresh_interval
+        self.index = None
+        self.version = None
+        self.checked = 0
+        self.lock = threading.Lock()
+
+    def table_version(self):
+        response = clickhouse_query(
+            "SELECT sum(rows), max(modification_time) FROM system.parts "
+            "WHERE database = currentDatabase() AND table = 'questions' AND active")
+        return response.result_rows[0]
+
+    def refresh(self):
+        with self.lock:
+            if self.index is not None and time.monotonic() - self.checked < self.refresh_interval:
+                return self.index
+            version = self.table_version()
+            if self.index is None or version != self.version:
+                response = clickhouse_query(
+                    "SELECT question, query, embedding FROM questions WHERE length(embedding) > 0")
+                rows = response.result_rows
+                self.index = VectorIndex([row[2] for row in rows], [(row[0], row[1]) for row in rows], metric="l2")
+                self.version = version
+            self.checked = time.monotonic()
+            return self.index
+
+    def search(self, embeddings, k=1):
+        return self.refresh().search(embeddings, k=k)
+
+
+question_index = QuestionIndex(refresh_interval=int(os.getenv('QUESTION_INDEX_REFRESH_SECONDS', default=60))) \
+    if os.getenv('QUESTION_INDEX', default='0') == '1' else None
+
+
+@tracing.traced("nearest_example_questions")
+def nearest_example_questions(embeddings):
+    """Resolves the closest question for each embedding in a single query, returning rows per embedding.
+
+    The vectors are sent as binary external data rather than formatted into the SQL text.
+    """
+    if not embeddings:
+        return []
+    if question_index is not None:
+        return question_index.search(embeddings, k=1)
+    if compact_embeddings:
+        # candidates are looked up by the primary key, so only their full precision embeddings are read
+        response = clickhouse_query(
+            "SELECT n, argMin((question, query), L2Distance(questions.embedding, targets.embedding)) "
+            "FROM questions CROSS JOIN targets WHERE question IN (SELECT question FROM questions CROSS JOIN targets "
+            f"ORDER BY L2Distance(questions.embedding_bf16, targets.embedding) ASC LIMIT {rerank_candidates} BY n) "
+            "GROUP BY n",
+            external_data=embeddings_external_data(embeddings))
+    else:
+        response = clickhouse_query(
+            "SELECT n, argMin((question, query), L2Distance(questions.embedding, targets.embedding)) "
+            "FROM questions CROSS JOIN targets GROUP BY n",
+            external_data=embeddings_external_data(embeddings))
+    nearest = {row[0]: row[1] for row in response.result_rows}
+    return [[nearest[n]] if n in nearest else [] for n in range(1, len(embeddings) + 1)]
+
+
+def format_example_questions(results):
     examples = []
     added = set()
-    for metric in metrics:
-        embedding = generate_embedding(metric)
-        response = clickhouse_client.query(
-            f"SELECT question, query FROM questions ORDER BY L2Distance(embedding, {embedding}) ASC LIMIT 1")
-        for query in response.result_rows:
+    for rows in results:
+        for query in rows:
             if not query[0] in added:
                 examples.append(f"/*Answer the following: {query[0].lower()}:*/\n{query[1]}")
             added.add(query[0])
     return examples
 
 
+def find_example_questions_for_metrics(metrics):
+    return format_example_questions(nearest_example_questions([generate_embedding_vector(metric)
+                                                               for metric in metrics]))
+
+
+@tracing.traced("find_pages_for_concept")
 def find_pages_for_concept(concept, limit=3):
+    if page_retrieval == "chunks":
+        return find_chunks_for_concept(concept, limit=limit)
+    if page_search == "ann":
+        return find_pages_for_concept_ann(concept, limit=limit)
+    if compact_embeddings:
+        return find_pages_for_concept_compact(concept, limit=limit)
     embedding = generate_embedding(concept)
-    response = clickhouse_client.query(
+    response = clickhouse_query(
         f"SELECT url, title, content FROM site_pages ORDER BY cosineDistance(embedding, {embedding}) ASC LIMIT {limit}")
     return [result for result in response.result_rows]
 
 
+def find_pages_for_concept_compact(concept, limit=3):
+    """Finds the closest pages by the BFloat16 embeddings, re-ranking the candidates with the full embeddings"""
+    embedding = generate_embedding_vector(concept)
+    response = clickhouse_query(
+        "SELECT url, title, content, cosineDistance(embedding, {embedding:Array(Float32)}) AS distance "
+        "FROM site_pages WHERE url IN (SELECT url FROM site_pages "
+        "ORDER BY cosineDistance(embedding_bf16, {embedding:Array(Float32)}) ASC LIMIT {candidates:UInt32}) "
+        "ORDER BY distance ASC LIMIT {limit:UInt32}",
+        parameters={"embedding": embedding, "limit": limit, "candidates": max(rerank_candidates, limit)})
+    return [result[:3] for result in response.result_rows]
+
+
+def find_chunks_for_concept(concept, limit=3):
+    """Finds the best matching chunk of each of the closest pages in site_page_chunks (see ga.sql), returning
+    (url, title, chunk) so only the relevant part of each page is sent to the model."""
+    embedding = generate_embedding_vector(concept)
+    if compact_embeddings:
+        response = clickhouse_query(
+            "SELECT url, title, chunk FROM site_page_chunks WHERE (url, chunk_number) IN "
+            "(SELECT url, chunk_number FROM site_page_chunks "
+            "ORDER BY cosineDistance(embedding_bf16, {embedding:Array(Float32)}) ASC LIMIT {candidates:UInt32}) "
+            "ORDER BY cosineDistance(embedding, {embedding:Array(Float32)}) ASC LIMIT 1 BY url LIMIT {limit:UInt32}",
+            parameters={"embedding": embedding, "limit": limit, "candidates": max(rerank_candidates, limit)})
+        return [result for result in response.result_rows]
+    response = clickhouse_query(
+        "SELECT url, title, chunk FROM site_page_chunks "
+        "ORDER BY cosineDistance(embedding, {embedding:Array(Float32)}) ASC LIMIT 1 BY url LIMIT {limit:UInt32}",
+        parameters={"embedding": embedding, "limit": limit})
+    return [result for result in response.result_rows]
+
+
+def find_pages_for_concept_ann(concept, limit=3):
+    """Finds pages using the vector similarity index on site_pages (see ga.sql).
+
+    The nearest urls are found first using the index, reading only the embedding column, with content then read
+    for just those urls via the primary key. Recall can be traded for speed with PAGE_SEARCH_CANDIDATES.
+    """
+    embedding = generate_embedding_vector(concept)
+    response = clickhouse_query(
+        "SELECT url, title, content, cosineDistance(embedding, {embedding:Array(Float32)}) AS distance "
+        "FROM site_pages WHERE url IN (SELECT url FROM site_pages "
+        "ORDER BY cosineDistance(embedding, {embedding:Array(Float32)}) ASC LIMIT {limit:UInt32}) "
+        "ORDER BY distance ASC LIMIT {limit:UInt32}",
+        parameters={"embedding": embedding, "limit": limit},
+        settings={"hnsw_candidate_list_size_for_search": page_search_candidates})
+    return [result[:3] for result in response.result_rows]
+
+
+def quote_string(value):
+    """Quotes a value as a ClickHouse string literal"""
+    return "'" + value.replace("\\", "\\\\").replace("'", "\\'") + "'"
+
+
+def escape_like(value):
+    return re.sub(r"([\\%_])", r"\\\1", value)
+
+
+def content_filter_sql(phrases):
+    """Condition matching site_pages containing any of the phrases, case insensitively"""
+    if content_filter == "ilike":
+        return " OR ".join(f"content ILIKE {quote_string('%' + escape_like(phrase) + '%')}" for phrase in phrases)
+    needles = sorted(set(phrase.lower() for phrase in phrases))
+    return f"multiSearchAny(lowerUTF8(content), [{', '.join(quote_string(needle) for needle in needles)}])"
+
+
 def extract_by_tag(response: str, tag: str, extract_all=False):
     soup = BeautifulSoup(response, features="html.parser")
     results = soup.find_all(tag)
@@ -86,39 +335,59 @@ def extract_site_area_examples(question):
     return list(site_areas)
 
 
-def summary_phrases(concept, num_docs=3):
-    pages = find_pages_for_concept(concept, limit=num_docs)
-    words = []
-    for c in pages:
-        summary_prompt = f"""Human: Extract up to 3 keywords and phrases from the following text related to \"{concept}\".
+@tracing.traced("extract_page_phrases")
+def extract_page_phrases(concept, content, model_id="anthropic.claude-v2"):
+    summary_prompt = f"""Human: Extract up to 3 keywords and phrases from the following text related to \"{concept}\".
             If words in \"{concept}\" are present include them.
-            {c[2]}
+            {content}
             Put the extracted words in xml tags <word></word>.
             Assistant:
             """
-        body = json.dumps({
-            "prompt": summary_prompt,
-            "max_tokens_to_sample": 4096,
-            "temperature": 0,
-            "top_p": 0.8,
-            "stop_sequences": ["\n\nHuman:"]
-        })
-        response = bedrock_with_backoff(body=body,
-                                        modelId="anthropic.claude-v2",
-                                        accept=accept, contentType=contentType)
-        response_body = json.loads(response.get("body").read())
-        for phrase in extract_by_tag(response_body.get('completion'), "word", extract_all=True):
-            words.append(phrase.strip().lower())
+    body = json.dumps({
+        "prompt": summary_prompt,
+        "max_tokens_to_sample": 4096,
+        "temperature": 0,
+        "top_p": 0.8,
+        "stop_sequences": ["\n\nHuman:"]
+    })
+    response = bedrock_with_backoff(body=body,
+                                    modelId=model_id,
+                                    accept=accept, contentType=contentType)
+    response_body = json.loads(response.get("body").read())
+    return [phrase.strip().lower() for phrase in
+            extract_by_tag(response_body.get('completion'), "word", extract_all=True) or []]
+
+
+def page_phrases(concept, page, model_id="anthropic.claude-v2"):
+    """Extracts phrases for a (url, title, content) page, memoized on the page content, concept and model"""
+    url, _, content = page
+    cache = get_phrase_cache()
+    if cache is not None:
+        phrases = cache.get(url, content, concept, model_id)
+        if phrases is not None:
+            return phrases
+    phrases = extract_page_phrases(concept, content, model_id=model_id)
+    if cache is not None:
+        cache.put(url, content, concept, model_id, phrases)
+    return phrases
+
+
+def summary_phrases(concept, num_docs=3):
+    pages = find_pages_for_concept(concept, limit=num_docs)
+    words = []
+    for c in pages:
+        words.extend(page_phrases(concept, c))
     return list(set(words))
 
 
-def generate_sql(question, examples, debug=False):
-    examples = '\n\n'.join(examples)
-    sql_prompt_data = f"""\n\nHuman: You have to generate ClickHouse SQL using natural language query/request <request></request>. Your goal -- create accurate ClickHouse SQL statements and help user extract data from ClickHouse database. You will be provided with rules <rules></rules>, database schema <schema></schema> and relevant SQL statement examples </examples></examples>.
+def warm_phrases(concepts, executor, num_docs=3):
+    """Pre-computes the phrases for the pages of each concept so questions about them skip keyword extraction"""
+    futures = [executor.submit(summary_phrases, concept, num_docs) for concept in concepts]
+    return [future.result() for future in futures]
 
-This is the table schema for ga_daily.
 
-<schema>
+# the full hand-written schema, used when PROMPT_SCHEMA=static
+STATIC_SCHEMA = """<schema>
 CREATE TABLE ga_daily
 (
     `event_date` Date,
@@ -160,9 +429,9 @@ CREATE TABLE default.site_pages
 )
 ENGINE = MergeTree
 ORDER BY url
-</schema>
+</schema>"""
 
-<rules> 
+SQL_RULES = """<rules> 
 You can use the tables "ga_daily" and "site_pages".  
 
 The table ga_daily contains website analytics data with a row for user events. The following columns are important:
@@ -176,9 +445,55 @@ The table ga_daily contains website analytics data with a row for user events. T
     - user_first_touch_timestamp - The first time a user visited the site.
     - page_location - the full url of the page. 
     - page_title - The page title e.g. for a doc or blog.
-    - page_referer - The referer for the page. A full url.
+    - page_referrer - The referrer for the page. A full url.
     - traffic_source.name provides the source of the traffic.
-</rules>
+</rules>"""
+
+# the hand-written rollup schema, added to STATIC_SCHEMA when GA_ROLLUP=1
+STATIC_ROLLUP_SCHEMA = """<schema>
+CREATE TABLE ga_daily_rollup
+(
+    `event_date` Date,
+    `event_name` String,
+    `page_location` String,
+    `events` SimpleAggregateFunction(sum, UInt64),
+    `users` AggregateFunction(uniq, Nullable(String)),
+    `active_users` AggregateFunction(uniq, Nullable(String)),
+    `returning_users` AggregateFunction(uniqExact, Nullable(String)),
+    `sessions` AggregateFunction(uniqExact, String, String, Nullable(String))
+)
+ENGINE = AggregatingMergeTree
+ORDER BY (event_date, event_name, page_location)
+</schema>"""
+
+# added to the rules when the rollup table exists
+ROLLUP_RULES = """
+You can also use the table "ga_daily_rollup", a much smaller daily rollup of ga_daily by event_name and page_location. Prefer it over ga_daily whenever the question only needs event_date, event_name and page_location, or a coarser grain:
+    - events - the number of events. Use sum(events) for new users (event_name 'first_visit') and page views (event_name 'page_view').
+    - users - use uniqMerge(users) for total users, filtering event_name 'session_start'.
+    - active_users - use uniqMerge(active_users) for active users, filtering event_name IN ('session_start', 'first_visit').
+    - returning_users - use uniqExactMerge(returning_users) for returning users, filtering event_name 'session_start'.
+    - sessions - use uniqExactMerge(sessions) for total sessions.
+Use ga_daily for any other column, or for a grain finer than a day such as event_timestamp.
+"""
+
+prompt_schema_mode = os.getenv('PROMPT_SCHEMA', default='pruned')
+# whether the hand-written schema includes ga_daily_rollup. The pruned schema includes it if the table exists
+static_rollup = os.getenv('GA_ROLLUP', default='0') == '1'
+prompt_token_budget = int(os.getenv('PROMPT_TOKEN_BUDGET', default=3000))
+schema_cache = SchemaCache(clickhouse_query,
+                           refresh_interval=int(os.getenv('SCHEMA_REFRESH_SECONDS', default=300)))
+
+
+def sql_prompt(question, schema, rules, examples):
+    examples = '\n\n'.join(examples)
+    return f"""\n\nHuman: You have to generate ClickHouse SQL using natural language query/request <request></request>. Your goal -- create accurate ClickHouse SQL statements and help user extract data from ClickHouse database. You will be provided with rules <rules></rules>, database schema <schema></schema> and relevant SQL statement examples </examples></examples>.
+
+This is the table schema for ga_daily.
+
+{schema}
+
+{rules}
 
 <examples>
 {examples}
@@ -191,22 +506,190 @@ Put the result statement in <sql></sql> tags:
 
 \n\nAssistant:
 """
+
+
+def sql_request_body(question, examples, debug=False, terms=()):
+    """Builds the SQL generation request. The schema is pruned to the columns relevant to the question and terms
+    (key metrics and concept), then the examples, most relevant first, are added until the token budget is used."""
+    schema, omitted = schema_cache.render([question, *terms]) if prompt_schema_mode == "pruned" else (None, set())
+    rules = prune_rules(SQL_RULES, omitted)
+    # fall back to the hand-written schema if the tables couldn't be read
+    if schema is None:
+        schema = f"{STATIC_SCHEMA}\n\n{STATIC_ROLLUP_SCHEMA}" if static_rollup else STATIC_SCHEMA
+    if "CREATE TABLE ga_daily_rollup" in schema:
+        rules = rules.replace("</rules>", ROLLUP_RULES + "</rules>")
+    examples = fit_examples(examples, estimate_tokens(sql_prompt(question, schema, rules, [])), prompt_token_budget)
+    sql_prompt_data = sql_prompt(question, schema, rules, examples)
     if debug:
-        print(f"prompt: \n{sql_prompt_data}")
-    body = json.dumps({
+        print(f"prompt ({estimate_tokens(sql_prompt_data)} tokens estimated): \n{sql_prompt_data}")
+    # stopping at </sql> avoids paying for any explanation the model adds after the statement
+    return json.dumps({
         "prompt": sql_prompt_data,
         "max_tokens_to_sample": 3000,
         "temperature": 0,
         "top_k": 100,
-        "stop_sequences": ["\n\nHuman:"]
+        "stop_sequences": ["\n\nHuman:", "</sql>"]
     })
+
+
+@tracing.traced("generate_sql")
+def generate_sql(question, examples, debug=False, terms=()):
+    body = sql_request_body(question, examples, debug=debug, terms=terms)
     response = bedrock_with_backoff(body=body,
                                     modelId="anthropic.claude-v2",
                                     accept=accept, contentType=contentType)
     response_body = json.loads(response.get("body").read())
-    return response_body.get('completion')
-
-
+    completion = response_body.get('completion')
+    if response_body.get('stop') == "</sql>":
+        completion += "</sql>"
+    return completion
+
+
+@retry(wait=wait_random_exponential(min=1, max=60), stop=stop_after_attempt(20), before_sleep=tracing.record_retry)
+def bedrock_stream_with_backoff(**kwargs):
+    response = get_client().invoke_model_with_response_stream(**kwargs)
+    tracing.record_bedrock(kwargs.get("body", ""), response)
+    return response
+
+
+@tracing.traced("generate_sql")
+def generate_sql_stream(question, examples, debug=False, on_sql=None, terms=()):
+    """Streams the SQL completion, returning as soon as the closing </sql> tag arrives and cancelling the rest of
+    the generation. on_sql is called with each new fragment of the statement as it is generated."""
+    body = sql_request_body(question, examples, debug=debug, terms=terms)
+    response = bedrock_stream_with_backoff(body=body,
+                                           modelId="anthropic.claude-v2",
+                                           accept=accept, contentType=contentType)
+    stream = response.get("body")
+    completion = ""
+    emitted = 0
+    try:
+        for event in stream:
+            chunk = event.get("chunk")
+            if chunk is None:
+                continue
+            chunk_body = json.loads(chunk.get("bytes").decode("utf-8"))
+            completion += chunk_body.get("completion", "")
+            # the final chunk carries the token counts, which streams don't return as headers
+            metrics = chunk_body.get("amazon-bedrock-invocationMetrics")
+            if metrics is not None:
+                tracing.record_tokens(metrics.get("inputTokenCount", 0), metrics.get("outputTokenCount", 0))
+            if chunk_body.get("stop") == "</sql>":
+                completion += "</sql>"
+            start = completion.find("<sql>")
+            if start == -1:
+                continue
+            start += len("<sql>")
+            end = completion.find("</sql>", start)
+            # hold back a possible partial closing tag until the next chunk
+            available = end if end != -1 else max(start, len(completion) - len("</sql>") + 1)
+            if on_sql is not None and available > start + emitted:
+                on_sql(completion[start + emitted:available])
+                emitted = available - start
+            if end != -1:
+                break
+    finally:
+        stream.close()
+    return completion
+
+
+@tracing.traced("validate_sql")
+def estimate_sql(sql):
+    """Runs EXPLAIN ESTIMATE for the statement, returning the parts, rows and marks it would read in total, plus
+    bytes estimated from the average compressed row size of each table. Raises DatabaseError if the SQL is invalid."""
+    estimates = clickhouse_query(f"EXPLAIN ESTIMATE {sql.strip().rstrip(';')}").result_rows
+    tables = [table for _, table, _, _, _ in estimates]
+    row_bytes = {table: row_size for table, row_size in clickhouse_query(
+        "SELECT table, sum(data_compressed_bytes) / sum(rows) FROM system.parts "
+        "WHERE active AND database = currentDatabase() AND table IN {tables:Array(String)} GROUP BY table",
+        parameters={"tables": tables}).result_rows} if tables else {}
+    estimate = {
+        "parts": sum(parts for _, _, parts, _, _ in estimates),
+        "rows": sum(rows for _, _, _, rows, _ in estimates),
+        "marks": sum(marks for _, _, _, _, marks in estimates),
+        "bytes": int(sum(rows * row_bytes.get(table, 0) for _, table, _, rows, _ in estimates)),
+    }
+    tracing.record_estimate(estimate)
+    return estimate
+
+
+def validation_feedback(sql):
+    """Returns the estimate for the statement, or None if it couldn't be made, and the reason the statement should be
+    regenerated, or None if it is valid and within the limits"""
+    try:
+        estimate = estimate_sql(sql)
+    except OperationalError as e:
+        # the server couldn't be reached, which says nothing about the statement
+        logging.warning(f"sql validation skipped: {e}")
+        return None, None
+    except DatabaseError as e:
+        return None, f"failed with the error: {str(e).strip()}"
+    if sql_max_estimated_rows and estimate["rows"] > sql_max_estimated_rows:
+        return estimate, (f"would read an estimated {estimate['rows']} rows, over the limit of "
+                          f"{sql_max_estimated_rows}. Filter on event_date or event_timestamp to read fewer rows")
+    if sql_max_estimated_bytes and estimate["bytes"] > sql_max_estimated_bytes:
+        return estimate, (f"would read an estimated {estimate['bytes']} bytes, over the limit of "
+                          f"{sql_max_estimated_bytes}. Read fewer columns and filter on event_date or event_timestamp")
+    return estimate, None
+
+
+def mask_sql(sql):
+    """Returns the statement with string literals, quoted identifiers, comments and anything within parentheses
+    masked, so clause keywords can be searched for at the top level. Offsets are preserved."""
+    masked = []
+    depth = 0
+    i = 0
+    while i < len(sql):
+        char = sql[i]
+        if char in "'\"`":
+            end = i + 1
+            while end < len(sql) and sql[end] != char:
+                end += 2 if sql[end] == "\\" else 1
+            end = min(end + 1, len(sql))
+            masked.append(char + "_" * max(end - i - 2, 0) + (char if end - i > 1 else ""))
+            i = end
+        elif sql.startswith("--", i) or sql.startswith("/*", i):
+            end = sql.find("\n" if char == "-" else "*/", i)
+            end = len(sql) if end == -1 else end + (0 if char == "-" else 2)
+            masked.append(" " * (end - i))
+            i = end
+        else:
+            if char == ")":
+                depth = max(depth - 1, 0)
+            masked.append(char if depth == 0 or char in "()" else "_")
+            if char == "(":
+                depth += 1
+            i += 1
+    return "".join(masked)
+
+
+def add_settings(sql, settings):
+    """Adds the settings to the statement, extending its SETTINGS clause if that is the final clause and keeping a
+    trailing FORMAT clause last"""
+    if not settings:
+        return sql
+    clause = ", ".join(f"{name} = {value}" for name, value in settings.items())
+    sql = sql.strip().rstrip(";").rstrip()
+    masked = mask_sql(sql)
+    output_format = re.search(r"\bFORMAT\s+\w+\s*$", masked, re.IGNORECASE)
+    head, tail = (sql[:output_format.start()].rstrip(), "\n" + sql[output_format.start():]) if output_format \
+        else (sql, "")
+    masked = masked[:len(head)]
+    final_settings = re.search(r"\bSETTINGS(\s+\w+\s*=\s*[^\s,]+\s*)(,\s*\w+\s*=\s*[^\s,]+\s*)*$", masked,
+                               re.IGNORECASE)
+    if final_settings is None:
+        return f"{head}\nSETTINGS {clause}{tail}"
+    start = final_settings.start() + len("SETTINGS")
+    assignments = [(assignment.group(1), head[start + assignment.start():start + assignment.end()])
+                   for assignment in re.finditer(r"(\w+)\s*=\s*[^\s,]+", masked[start:])]
+    if not any(name in settings for name, _ in assignments):
+        return f"{head}, {clause}{tail}"
+    # the configured settings replace any the statement already sets
+    kept = [assignment for name, assignment in assignments if name not in settings]
+    return f"{head[:final_settings.start()]}SETTINGS {', '.join(kept + [clause])}{tail}"
+
+
+@tracing.traced("identify_concept")
 def identify_concept(question):
     prompt_data = f"""Human: \n\nYou are an agent responsible for identifying the components of question which require a 
                 text field to be searched in a database over just metadata. 
@@ -254,6 +737,7 @@ def identify_concept(question):
     return extract_by_tag(response_body.get("completion").strip(), "words")
 
 
+@tracing.traced("extract_key_metrics")
 def extract_key_metrics(question):
     prompt_data = f"""Human: \n\nYou are an agent responsible for analyzing questions that would require analysis of a dataset using SQL.
                 You must extract the key metrics for the SELECT clause that must be used in order to answer the question.
@@ -303,28 +787,222 @@ def extract_key_metrics(question):
     return extract_by_tag(response_body.get("completion").strip(), "metric", extract_all=True)
 
 
+async def examples_for_metrics(question, run):
+    key_metrics = await run(extract_key_metrics, question)
+    if not key_metrics:
+        return [], []
+    # embed all metrics at once, then resolve every nearest question in one query
+    embeddings = await asyncio.gather(*[run(generate_embedding_vector, metric) for metric in key_metrics])
+    return key_metrics, format_example_questions(await run(nearest_example_questions, list(embeddings)))
+
+
+async def phrases_for_concept(question, run):
+    concept = await run(identify_concept, question)
+    if concept == "all_docs":
+        return concept, []
+    pages = await run(find_pages_for_concept, concept, 3)
+    # keyword extraction is independent per page
+    results = await asyncio.gather(*[run(page_phrases, concept, page) for page in pages])
+    return concept, list(set(phrase for phrases in results for phrase in phrases))
+
+
+async def answer_question(question, executor, debug=False, stream=False, on_sql=None, on_estimate=None):
+    """Runs the RAG pipeline for a question, returning the model completion containing the SQL.
+
+    Metric extraction and concept identification are independent so run concurrently, with their
+    dependent lookups fanned out on the executor. Only generate_sql waits on both. With SQL_VALIDATION=1,
+    on_estimate is called with the parts, rows, marks and bytes the returned statement is estimated to read.
+    """
+    with tracing.span("question"):
+        return await run_pipeline(question, executor, debug=debug, stream=stream, on_sql=on_sql,
+                                  on_estimate=on_estimate)
+
+
+async def run_pipeline(question, executor, debug=False, stream=False, on_sql=None, on_estimate=None):
+    loop = asyncio.get_running_loop()
+
+    def run(fn, *args):
+        # executor threads don't inherit context, so pass the current span along with each call
+        return loop.run_in_executor(executor, contextvars.copy_context().run, fn, *args)
+
+    answer_cache = get_answer_cache()
+    if answer_cache is not None:
+        question_embedding = await run(generate_embedding_vector, question)
+        cached = await run(answer_cache.lookup, question_embedding)
+        if cached is not None:
+            if debug:
+                print(f"answer cache hit: {cached[0]} (similarity {cached[2]:.4f})")
+            if on_sql is not None:
+                on_sql(extract_by_tag(cached[1], "sql") or "")
+            return cached[1]
+
+    (key_metrics, metric_examples), (concept, phrases) = await asyncio.gather(examples_for_metrics(question, run),
+                                                                              phrases_for_concept(question, run))
+    # examples are in rank order, the last are dropped first if the prompt is over budget
+    examples = extract_site_area_examples(question) + metric_examples
+    terms = list(key_metrics)
+    prompt_question = question
+    if concept != "all_docs":
+        prompt_question = f"{question}. For the topic of {concept}, filter by {','.join(phrases)}"
+        terms.append(concept)
+    if concept != "all_docs" and phrases:
+        # the question depends on this filter, so it ranks first
+        examples.insert(0, f"/*Answer the following: To filter by pages containing words:*/ \n SELECT page_location FROM ga_daily WHERE page_location IN (SELECT url FROM site_pages WHERE {content_filter_sql(phrases)})\n")
+    if stream:
+        sql = await run(generate_sql_stream, prompt_question, examples, debug, on_sql, terms)
+    else:
+        sql = await run(generate_sql, prompt_question, examples, debug, terms)
+    statement = extract_by_tag(sql, "sql")
+    if sql_validation and statement:
+        estimate, feedback = await run(validation_feedback, statement)
+        if feedback is not None:
+            if debug:
+                print(f"regenerating, the statement {feedback}")
+            # when streaming, the regenerated statement follows the first
+            retry_question = (f"{prompt_question}\n\nA previous attempt generated the statement:\n{statement}\n"
+                              f"which {feedback}\nGenerate a corrected statement")
+            if stream:
+                if on_sql is not None:
+                    on_sql("\n")
+                sql = await run(generate_sql_stream, retry_question, examples, debug, on_sql, terms)
+            else:
+                sql = await run(generate_sql, retry_question, examples, debug, terms)
+            statement = extract_by_tag(sql, "sql")
+            # the estimate reported is for the statement returned
+            estimate, _ = await run(validation_feedback, statement) if statement else (None, None)
+        if estimate is not None:
+            if debug:
+                print(f"estimated to read {estimate['rows']} rows, {estimate['bytes']} bytes and "
+                      f"{estimate['parts']} parts")
+            if on_estimate is not None:
+                on_estimate(estimate)
+    match = re.search(r"<sql>(.*?)</sql>", sql, re.DOTALL)
+    if sql_settings and match:
+        limited = add_settings(match.group(1), sql_settings)
+        if stream and on_sql is not None:
+            generated = match.group(1).strip().rstrip(";").rstrip()
+            # settings inserted before a FORMAT clause can't be streamed as a suffix, so the statement follows in full
+            on_sql(limited[len(generated):] if limited.startswith(generated) else f"\n{limited}")
+        sql = sql[:match.start(1)] + limited + sql[match.end(1):]
+    if answer_cache is not None and extract_by_tag(sql, "sql"):
+        await run(answer_cache.store, question, question_embedding, sql)
+    return sql
+
+
+async def answer_questions(questions, executor, output, batch_concurrency=4, stream=False):
+    """Answers questions with up to batch_concurrency in flight, writing JSONL results in input order"""
+    semaphore = asyncio.Semaphore(batch_concurrency)
+
+    async def answer(question):
+        async with semaphore:
+            start = time.monotonic()
+            result = {"question": question}
+            try:
+                sql = extract_by_tag(await answer_question(question, executor, stream=stream,
+                                                           on_estimate=lambda estimate: result.update(
+                                                               estimate=estimate)), "sql")
+                return {**result, "sql": sql, "seconds": round(time.monotonic() - start, 3)}
+            except Exception as e:
+                return {"question": question, "error": str(e), "seconds": round(time.monotonic() - start, 3)}
+
+    tasks = [asyncio.create_task(answer(question)) for question in questions]
+    for task in tasks:
+        output.write(json.dumps(await task) + "\n")
+        output.flush()
+
+
+def serve(host, port, executor):
+    """Serves POST requests of {"question": "..."} with {"question": "...", "sql": "..."} responses, including the
+    "estimate" of the rows and bytes the statement would read when SQL_VALIDATION=1"""
+
+    class QuestionHandler(BaseHTTPRequestHandler):
+
+        def respond(self, status, body):
+            data = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_POST(self):
+            try:
+                request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                question = request["question"]
+            except (ValueError, KeyError, TypeError):
+                return self.respond(400, {"error": "expected a JSON body with a question"})
+            result = {"question": question}
+            try:
+                sql = extract_by_tag(asyncio.run(answer_question(
+                    question, executor, on_estimate=lambda estimate: result.update(estimate=estimate))), "sql")
+                self.respond(200, {**result, "sql": sql})
+            except Exception as e:
+                self.respond(500, {"question": question, "error": str(e)})
+
+    # create the clients up front so the first request doesn't pay for it
+    get_clickhouse_client()
+    get_client()
+    server = ThreadingHTTPServer((host, port), QuestionHandler)
+    print(f"listening on {host}:{port}")
+    sys.stdout.flush()
+    server.serve_forever()
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="RAG pipeline for Google Analytics with ClickHouse and Bedrock")
     parser.add_argument("--question", type=str, help="Question")
     parser.add_argument("--show_prompt", action="store_true", default=False, help="Show final model prompt")
+    parser.add_argument("--warm_concepts", type=str, default=None,
+                        help="File of concepts, one per line, to pre-compute page phrases for")
+    parser.add_argument("--questions_file", type=str, default=None,
+                        help="File of questions, one per line, to answer as JSONL")
+    parser.add_argument("--output", type=str, default=None, help="JSONL output file for --questions_file")
+    parser.add_argument("--batch_concurrency", type=int, default=4,
+                        help="Number of questions from --questions_file answered at once")
+    parser.add_argument("--stream", action="store_true", default=False,
+                        help="Stream the SQL as it is generated, stopping at the end of the statement")
+    parser.add_argument("--serve", action="store_true", default=False, help="Serve questions over HTTP")
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="Host for --serve")
+    parser.add_argument("--port", type=int, default=8080, help="Port for --serve")
     args = parser.parse_args()
+    if args.warm_concepts:
+        with open(args.warm_concepts) as concepts_file:
+            concepts = [line.strip() for line in concepts_file if line.strip()]
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for concept, phrases in zip(concepts, warm_phrases(concepts, executor)):
+                print(f"{concept}: {','.join(phrases)}")
+        sys.exit(0)
+    if args.serve:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            serve(args.host, args.port, executor)
+        sys.exit(0)
+    if args.questions_file:
+        with open(args.questions_file) as questions_file:
+            questions = [line.strip() for line in questions_file if line.strip()]
+        output = open(args.output, "w") if args.output else sys.stdout
+        try:
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                asyncio.run(answer_questions(questions, executor, output, batch_concurrency=args.batch_concurrency,
+                                             stream=args.stream))
+        finally:
+            if args.output:
+                output.close()
+        sys.exit(0)
     question = args.question
     try:
         print("-" * 100)
         print(f"question: {question}")
-        key_metrics = extract_key_metrics(question)
-        examples = extract_site_area_examples(question)
-        if len(key_metrics) > 0:
-            examples = examples + find_example_questions_for_metrics(key_metrics)
-        concept = identify_concept(question)
-        if concept != "all_docs":
-            phrases = summary_phrases(concept, num_docs=3)
-            question = f"{question}. For the topic of {concept}, filter by {','.join(phrases)}"
-            filter = " OR ".join([f"content ILIKE '%{phrase}%'" for phrase in phrases])
-            examples.append(
-                f"/*Answer the following: To filter by pages containing words:*/ \n SELECT page_location FROM ga_daily WHERE page_location IN (SELECT url FROM site_pages WHERE {filter})\n")
-        sql = generate_sql(question, examples, debug=args.show_prompt)
-        print(extract_by_tag(sql, "sql"))
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            if args.stream:
+                def print_sql(fragment):
+                    print(fragment, end="", flush=True)
+
+                sql = asyncio.run(answer_question(question, executor, debug=args.show_prompt, stream=True,
+                                                  on_sql=print_sql))
+                print()
+            else:
+                sql = asyncio.run(answer_question(question, executor, debug=args.show_prompt))
+                print(extract_by_tag(sql, "sql"))
     except Exception as e:
         print(e)
     sys.stdout.flush()
@@ -13,7 +13,9 @@ INSERT INTO raw_questions (question, query) VALUES
 ('new users', $$SELECT count() AS new_users FROM ga_daily WHERE event_name = 'first_visit'$$),
 ('returning users', $$SELECT uniqExact(user_pseudo_id) AS returning_users FROM ga_daily WHERE (event_name = 'session_start') AND is_active_user AND (ga_session_number > 1 OR user_first_touch_timestamp < event_date)$$),
 ('total sessions', $$SELECT uniqExact(ga_session_id, '_', user_pseudo_id) AS total_sessions FROM ga_daily$$),
-('average views per page', $$SELECT page_location,count() FROM ga_daily WHERE (event_name = 'page_view') GROUP BY page_location$$)
+('average views per page', $$SELECT page_location,count() FROM ga_daily WHERE (event_name = 'page_view') GROUP BY page_location$$),
+('total users per country', $$SELECT geo.country AS country, uniq(user_pseudo_id) AS total_users FROM ga_daily WHERE event_name = 'session_start' GROUP BY country ORDER BY total_users DESC$$),
+('page views per hour', $$SELECT toStartOfHour(event_timestamp) AS hour, count() AS page_views FROM ga_daily WHERE (event_name = 'page_view') GROUP BY hour ORDER BY hour$$)
 
 CREATE TABLE questions
 (
@@ -28,4 +30,49 @@ INSERT INTO questions SELECT
     question,
     query,
     embed(question) AS embedding
-FROM raw_questions
\ No newline at end of file
+FROM raw_questions
+
+
+-- optional: examples reading ga_daily_rollup. Only run these after creating the rollup in ga.sql. They replace the
+-- canonical examples reading ga_daily, so the closest example for a metric uses the rollup.
+
+CREATE TABLE raw_rollup_questions
+(
+    `question` String,
+    `query` String
+)
+ENGINE = MergeTree
+ORDER BY question
+
+INSERT INTO raw_rollup_questions (question, query) VALUES
+('total users', $$SELECT uniqMerge(users) AS total_users FROM ga_daily_rollup WHERE event_name = 'session_start'$$),
+('total users per day', $$SELECT event_date, uniqMerge(users) AS total_users FROM ga_daily_rollup WHERE event_name = 'session_start' GROUP BY event_date ORDER BY event_date$$),
+('active users', $$SELECT uniqMerge(active_users) AS active_users FROM ga_daily_rollup WHERE event_name IN ('session_start', 'first_visit')$$),
+('active users per day', $$SELECT event_date, uniqMerge(active_users) AS active_users FROM ga_daily_rollup WHERE event_name IN ('session_start', 'first_visit') GROUP BY event_date ORDER BY event_date$$),
+('total page views', $$SELECT sum(events) AS total_page_views FROM ga_daily_rollup WHERE event_name = 'page_view'$$),
+('page views per page', $$SELECT page_location, sum(events) AS page_views FROM ga_daily_rollup WHERE event_name = 'page_view' GROUP BY page_location ORDER BY page_views DESC$$),
+('new users', $$SELECT sum(events) AS new_users FROM ga_daily_rollup WHERE event_name = 'first_visit'$$),
+('new users per day', $$SELECT event_date, sum(events) AS new_users FROM ga_daily_rollup WHERE event_name = 'first_visit' GROUP BY event_date ORDER BY event_date$$),
+('returning users', $$SELECT uniqExactMerge(returning_users) AS returning_users FROM ga_daily_rollup WHERE event_name = 'session_start'$$),
+('returning users per day', $$SELECT event_date, uniqExactMerge(returning_users) AS returning_users FROM ga_daily_rollup WHERE event_name = 'session_start' GROUP BY event_date ORDER BY event_date$$),
+('total sessions', $$SELECT uniqExactMerge(sessions) AS total_sessions FROM ga_daily_rollup$$),
+('total sessions per day', $$SELECT event_date, uniqExactMerge(sessions) AS total_sessions FROM ga_daily_rollup GROUP BY event_date ORDER BY event_date$$),
+('average views per page', $$SELECT page_location, sum(events) FROM ga_daily_rollup WHERE (event_name = 'page_view') GROUP BY page_location$$)
+
+DELETE FROM questions WHERE question IN (SELECT question FROM raw_rollup_questions)
+
+INSERT INTO questions SELECT
+    question,
+    query,
+    embed(question) AS embedding
+FROM raw_rollup_questions
+
+
+-- optional: compact BFloat16 copy of the question embeddings, used when COMPACT_EMBEDDINGS=1 alongside the copies in
+-- ga.sql. The nearest candidates are found reading half the bytes, then re-ranked with the full precision embedding.
+
+SET allow_experimental_bfloat16_type = 1
+
+ALTER TABLE questions ADD COLUMN embedding_bf16 Array(BFloat16) MATERIALIZED CAST(embedding, 'Array(BFloat16)')
+
+ALTER TABLE questions MATERIALIZE COLUMN embedding_bf16
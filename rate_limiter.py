@@ -0,0 +1,140 @@
+"""Adaptive rate limiting of Bedrock requests shared by every process on the host.
+
+Each model has a token bucket stored in a small state file, locked with flock, so the embed UDF's executable_pool
+processes and question_to_sql.py all draw from the same budget. The rate adapts AIMD style: it increases additively
+with each successful request and halves (at most once per cooldown) when Bedrock responds with a
+ThrottlingException, settling at the account's actual quota rather than bursting into retry storms.
+
+The state files are created world-writable, so processes running as different users e.g. the clickhouse user's
+UDFs and question_to_sql.py share the same buckets. If a state file can't be used, requests are sent unpaced.
+
+Configured through the environment:
+    BEDROCK_RATE_LIMIT - set to 1 to enable (default 0)
+    BEDROCK_RATE_LIMIT_DIR - directory for the bucket state files (default <tmp>/bedrock_rate_limits)
+    BEDROCK_INITIAL_RATE - requests per second before any adaptation (default 5)
+    BEDROCK_MIN_RATE / BEDROCK_MAX_RATE - bounds for the adapted rate (default 0.2 and 100)
+"""
+import fcntl
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+
+
+class SharedRateLimiter:
+
+    def __init__(self, path, initial_rate=5.0, min_rate=0.2, max_rate=100.0, increase=0.5, decrease=0.5,
+                 cooldown=1.0):
+        self.path = path
+        self.initial_rate = initial_rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.cooldown = cooldown
+
+    def _open(self):
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o666)
+        try:
+            # the umask usually removes write access for other users
+            os.fchmod(fd, 0o666)
+        except OSError:
+            pass
+        return os.fdopen(fd, "r+")
+
+    def _update(self, fn):
+        """Applies fn(state, now) to the bucket state under an exclusive lock, returning its result, or None if the
+        state file can't be used"""
+        try:
+            return self._locked_update(fn)
+        except OSError as e:
+            logging.warning(f"bedrock rate limiting skipped: {e}")
+            return None
+
+    def _locked_update(self, fn):
+        with self._open() as state_file:
+            fcntl.flock(state_file, fcntl.LOCK_EX)
+            try:
+                state_file.seek(0)
+                try:
+                    state = json.loads(state_file.read())
+                except ValueError:
+                    state = {"rate": self.initial_rate, "tokens": 1.0, "updated": time.time(), "decreased": 0.0}
+                now = time.time()
+                # refill the bucket, holding at most one second of requests
+                state["tokens"] = min(max(state["rate"], 1.0),
+                                      state["tokens"] + max(now - state["updated"], 0) * state["rate"])
+                state["updated"] = now
+                result = fn(state, now)
+                state_file.seek(0)
+                state_file.truncate()
+                state_file.write(json.dumps(state))
+                return result
+            finally:
+                fcntl.flock(state_file, fcntl.LOCK_UN)
+
+    def acquire(self):
+        """Blocks until a request can be sent"""
+        def take(state, now):
+            if state["tokens"] >= 1:
+                state["tokens"] -= 1
+                return 0
+            return (1 - state["tokens"]) / state["rate"]
+
+        while True:
+            wait = self._update(take)
+            if wait is None or wait <= 0:
+                return
+            time.sleep(wait)
+
+    def succeeded(self):
+        def increase(state, now):
+            state["rate"] = min(self.max_rate, state["rate"] + self.increase / state["rate"])
+
+        self._update(increase)
+
+    def throttled(self):
+        def decrease(state, now):
+            # concurrent requests are usually throttled together, so only back off once per cooldown
+            if now - state["decreased"] >= self.cooldown:
+                state["rate"] = max(self.min_rate, state["rate"] * self.decrease)
+                state["decreased"] = now
+            state["tokens"] = min(state["tokens"], 0.0)
+
+        self._update(decrease)
+
+    def rate(self):
+        return self._update(lambda state, now: state["rate"])
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(model_id):
+    """Returns the shared limiter for a model, or None if rate limiting is disabled"""
+    if os.getenv("BEDROCK_RATE_LIMIT", default="0") != "1":
+        return None
+    with _limiters_lock:
+        if model_id not in _limiters:
+            directory = os.getenv("BEDROCK_RATE_LIMIT_DIR",
+                                  default=os.path.join(tempfile.gettempdir(), "bedrock_rate_limits"))
+            try:
+                os.makedirs(directory, exist_ok=True)
+            except OSError as e:
+                logging.warning(f"bedrock rate limiting skipped: {e}")
+                return None
+            try:
+                # shared by every user, with the sticky bit so only the owner can delete a file
+                os.chmod(directory, 0o1777)
+            except OSError:
+                pass
+            _limiters[model_id] = SharedRateLimiter(
+                os.path.join(directory, re.sub(r"[^\w.-]", "_", model_id) + ".json"),
+                initial_rate=float(os.getenv("BEDROCK_INITIAL_RATE", default=5)),
+                min_rate=float(os.getenv("BEDROCK_MIN_RATE", default=0.2)),
+                max_rate=float(os.getenv("BEDROCK_MAX_RATE", default=100)))
+        return _limiters[model_id]
@@ -0,0 +1,74 @@
+"""RowBinary encoding shared by embed.py, the external tables sent by question_to_sql.py and the benchmark, plus the
+TabSeparated fallback of the embed UDF.
+
+Strings and arrays are prefixed with their length as an unsigned LEB128 varint, and Float32 values are little-endian.
+"""
+import array
+import json
+
+
+def leb128(value):
+    encoded = bytearray()
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            encoded.append(byte | 0x80)
+        else:
+            encoded.append(byte)
+            return bytes(encoded)
+
+
+def read_leb128(data, offset):
+    """Returns the varint at offset in data and the offset following it"""
+    value = 0
+    shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7f) << shift
+        shift += 7
+        if not byte & 0x80:
+            return value, offset
+
+
+def encode_string(text):
+    encoded = text.encode("utf-8")
+    return leb128(len(encoded)) + encoded
+
+
+def read_string(stream):
+    """Reads a String from a binary stream"""
+    length = 0
+    shift = 0
+    while True:
+        byte = stream.read(1)[0]
+        length |= (byte & 0x7f) << shift
+        shift += 7
+        if not byte & 0x80:
+            return stream.read(length).decode("utf-8", errors="replace")
+
+
+def encode_float32_array(data):
+    """Encodes an Array(Float32) from the raw little-endian float32 bytes of its elements"""
+    return leb128(len(data) // 4) + data
+
+
+def read_float32_array(data, offset):
+    """Returns the raw float32 bytes of the Array(Float32) at offset in data and the offset following it"""
+    length, offset = read_leb128(data, offset)
+    return data[offset:offset + length * 4], offset + length * 4
+
+
+def read_strings(stream, count, io_format):
+    """Reads count String rows of the UDF's input format from a binary stream"""
+    if io_format == "RowBinary":
+        return [read_string(stream) for _ in range(0, count)]
+    return [stream.readline().decode("utf-8", errors="replace") for _ in range(0, count)]
+
+
+def encode_embedding(embedding, io_format):
+    """Encodes an embedding, given as float32 bytes, as a row of the UDF's output format"""
+    if io_format == "RowBinary":
+        return encode_float32_array(embedding)
+    return (json.dumps(array.array("f", embedding).tolist()) + "\n").encode("utf-8")
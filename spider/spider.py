@@ -1,13 +1,35 @@
 import clickhouse_connect
 from clickhouse_connect import common
 from scrapy.spiders import SitemapSpider
+import hashlib
+import queue
 import sys
+import threading
+import time
 
 MIN_PYTHON = (3, 10)
 if sys.version_info < MIN_PYTHON:
     sys.exit("Python %s.%s or later is required.\n" % MIN_PYTHON)
 
 
+COLUMNS = ['url', 'raw_title', 'raw_content', 'content_hash', 'etag', 'last_modified', 'lastmod', 'deleted']
+
+
+class ConditionalRequestMiddleware:
+    """Adds If-None-Match/If-Modified-Since headers for previously crawled pages when crawling incrementally, so
+    unchanged pages are answered with a bodiless 304"""
+
+    def process_request(self, request, spider):
+        page = spider.pages.get(request.url) if spider.incremental else None
+        if page is None or page["deleted"]:
+            return None
+        if page["etag"]:
+            request.headers.setdefault("If-None-Match", page["etag"])
+        if page["last_modified"]:
+            request.headers.setdefault("If-Modified-Since", page["last_modified"])
+        return None
+
+
 class Spider(SitemapSpider):
     name = "google-analytics-spider"
 
@@ -19,11 +41,31 @@ class Spider(SitemapSpider):
 
     custom_settings = {
         # Filters out Requests for URLs outside the domains covered by the spider.
-        "OffsiteMiddleware": True
+        "OffsiteMiddleware": True,
+        "DOWNLOADER_MIDDLEWARES": {"spider.ConditionalRequestMiddleware": 560}
     }
 
+    # pages removed from the site are tombstoned rather than left in the table, and unchanged pages (304) have
+    # their sitemap lastmod refreshed
+    handle_httpstatus_list = [304, 404, 410]
+
+    # With -a incremental=true only pages which are new or changed, according to the sitemap lastmod, HTTP
+    # conditional requests and the content hash, are inserted. Pages no longer in the sitemap are tombstoned.
+    incremental = "false"
+
+    # Inserts are buffered and flushed in batches by a background writer when any of these limits is reached.
+    # Can be overridden with -a e.g. -a batch_rows=1000
+    batch_rows = 500
+    batch_bytes = 64 * 1024 * 1024
+    flush_interval = 30
+    compression = "lz4"
+
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
+        self.batch_rows = int(self.batch_rows)
+        self.batch_bytes = int(self.batch_bytes)
+        self.flush_interval = float(self.flush_interval)
+        self.incremental = str(self.incremental).lower() in ("true", "1", "yes")
 
         common.set_setting('autogenerate_session_id', False)
         self.client = clickhouse_connect.get_client(
@@ -31,7 +73,109 @@ class Spider(SitemapSpider):
             port=self.port,
             username=self.username,
             password=self.password,
-            secure=True)
+            secure=True,
+            compress=self.compression)
+
+        # previously crawled pages by url, and every url listed in the sitemaps during this crawl
+        self.pages = self.load_pages() if self.incremental else {}
+        self.sitemap_lastmod = {}
+        # unchanged pages whose sitemap lastmod changed, by url
+        self.lastmod_updates = {}
+
+        # the writer inserts while the crawl continues, bounded so a slow server applies back pressure
+        self.rows = queue.Queue(maxsize=self.batch_rows * 4)
+        self.writer = threading.Thread(target=self.write_rows, name="clickhouse-writer", daemon=True)
+        self.writer.start()
+
+    def write_rows(self):
+        batch = []
+        batch_size = 0
+        deadline = time.monotonic() + self.flush_interval
+        while True:
+            try:
+                row = self.rows.get(timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                row = None
+            else:
+                if row is None:
+                    # spider closed
+                    self.flush(batch)
+                    return
+                batch.append(row)
+                batch_size += len(row[1]) + len(row[2])
+            if batch and (len(batch) >= self.batch_rows or batch_size >= self.batch_bytes
+                          or time.monotonic() >= deadline):
+                self.flush(batch)
+                batch = []
+                batch_size = 0
+            if time.monotonic() >= deadline:
+                deadline = time.monotonic() + self.flush_interval
+
+    def flush(self, batch):
+        if not batch:
+            return
+        try:
+            self.client.insert(
+                database=self.database,
+                table=self.table,
+                data=batch,
+                column_names=COLUMNS)
+            self.logger.info("Inserted %d pages", len(batch))
+        except Exception:
+            self.logger.exception("Failed to insert %d pages", len(batch))
+
+    def load_pages(self):
+        result = self.client.query(
+            f"SELECT url, content_hash, etag, last_modified, lastmod, deleted FROM {self.database}.{self.table} FINAL")
+        return {row[0]: {"content_hash": row[1], "etag": row[2], "last_modified": row[3], "lastmod": row[4],
+                         "deleted": row[5]} for row in result.result_rows}
+
+    def sitemap_filter(self, entries):
+        for entry in entries:
+            url = entry["loc"]
+            lastmod = entry.get("lastmod", "")
+            self.sitemap_lastmod[url] = lastmod
+            page = self.pages.get(url)
+            if self.incremental and page is not None and not page["deleted"] and lastmod \
+                    and page["lastmod"] == lastmod:
+                # unchanged since the last crawl
+                continue
+            yield entry
+
+    def refresh_lastmod(self, url):
+        """Records the new sitemap lastmod of an unchanged page, so the next incremental crawl skips it"""
+        lastmod = self.sitemap_lastmod.get(url, "")
+        if lastmod and self.pages[url]["lastmod"] != lastmod:
+            self.lastmod_updates[url] = lastmod
+
+    def write_lastmod_updates(self):
+        """Re-inserts unchanged pages with their new lastmod, copying the stored content within ClickHouse"""
+        updates = list(self.lastmod_updates.items())
+        for start in range(0, len(updates), self.batch_rows):
+            batch = updates[start:start + self.batch_rows]
+            try:
+                self.client.command(
+                    f"INSERT INTO {self.database}.{self.table} ({', '.join(COLUMNS)}) "
+                    f"SELECT url, raw_title, raw_content, content_hash, etag, last_modified, "
+                    f"transform(url, {{urls:Array(String)}}, {{lastmods:Array(String)}}, lastmod), 0 "
+                    f"FROM {self.database}.{self.table} FINAL WHERE url IN {{urls:Array(String)}} AND deleted = 0",
+                    parameters={"urls": [url for url, _ in batch], "lastmods": [lastmod for _, lastmod in batch]})
+                self.logger.info("Refreshed lastmod of %d unchanged pages", len(batch))
+            except Exception:
+                self.logger.exception("Failed to refresh lastmod of %d pages", len(batch))
+
+    def tombstone(self, url):
+        self.rows.put([url, '', '', '', '', '', self.sitemap_lastmod.get(url, ''), 1])
+
+    def closed(self, reason):
+        # only tombstone after a complete crawl, otherwise a failed sitemap fetch would remove every page
+        if self.incremental and reason == "finished" and self.sitemap_lastmod:
+            for url, page in self.pages.items():
+                if not page["deleted"] and url not in self.sitemap_lastmod:
+                    self.tombstone(url)
+        self.rows.put(None)
+        self.writer.join()
+        self.write_lastmod_updates()
 
     def is_url_of_interest(self, url):
         if "https://clickhouse.com/" not in url:
@@ -68,6 +212,17 @@ class Spider(SitemapSpider):
         if not self.is_url_of_interest(url):
             return
 
+        page = self.pages.get(url)
+        if response.status in (404, 410):
+            if page is not None and not page["deleted"]:
+                self.tombstone(url)
+            return
+
+        if response.status == 304:
+            if page is not None and not page["deleted"]:
+                self.refresh_lastmod(url)
+            return
+
         # ------- Get page's raw title (may include html tags) ---------------------------------------------------------
         raw_title = response.xpath("//head//title").get()
         if raw_title is None:
@@ -76,10 +231,16 @@ class Spider(SitemapSpider):
         # ------- Get page's raw content (may include html tags) -------------------------------------------------------
         raw_content = self.get_content(url, response)
 
-        # ------- Insert page's raw data into a ClickHouse table -------------------------------------------------------
+        # ------- Skip pages whose content hasn't changed since the last crawl ---------------------------------------
+        hash_input = raw_content if isinstance(raw_content, bytes) else raw_content.encode("utf-8")
+        content_hash = hashlib.sha256(raw_title.encode("utf-8") + b"\0" + hash_input).hexdigest()
+        if self.incremental and page is not None and not page["deleted"] and page["content_hash"] == content_hash:
+            self.refresh_lastmod(url)
+            return
+
+        # ------- Queue page's raw data for a batched insert into a ClickHouse table -----------------------------------
         # ------- Note that we use ClickHouse built-in text function for extracting the pure text
-        self.client.insert(
-            database=self.database,
-            table=self.table,
-            data=[[url, raw_title, raw_content]],
-            column_names=['url', 'raw_title', 'raw_content'])
+        self.rows.put([url, raw_title, raw_content, content_hash,
+                       response.headers.get("ETag", b"").decode("latin-1"),
+                       response.headers.get("Last-Modified", b"").decode("latin-1"),
+                       self.sitemap_lastmod.get(url, ""), 0])
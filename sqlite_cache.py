@@ -0,0 +1,43 @@
+"""Shared base of the local SQLite caches in embedding_cache.py, phrase_cache.py and answer_cache.py.
+
+Each thread keeps its own connection, since sqlite connections can't be shared across threads, and the database runs
+in WAL mode so the ClickHouse `executable_pool` processes running embed.py, and question_to_sql.py, can share it.
+"""
+import sqlite3
+import threading
+
+
+class SQLiteCache:
+
+    def __init__(self, path):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _record(self, hit):
+        """Counts a lookup against this process's hits or misses"""
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+
+def print_stats(cache, disabled_message):
+    """Prints the statistics of a cache returned by one of the get_*_cache functions, for running a module directly"""
+    if cache is None:
+        print(disabled_message)
+    else:
+        for stat, value in cache.stats().items():
+            print(f"{stat}: {value}")
@@ -0,0 +1,31 @@
+import os
+import sqlite3
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import embedding_cache  # noqa: E402
+from embedding_cache import EmbeddingCache  # noqa: E402
+
+
+def test_database_errors_are_misses(tmp_path):
+    cache = EmbeddingCache(path=str(tmp_path / "embedding_cache.db"))
+    cache.put("model", "text", [1.0, 2.0])
+    assert cache.get("model", "text") == [1.0, 2.0]
+
+    def locked():
+        raise sqlite3.OperationalError("database is locked")
+
+    cache._connection = locked
+    assert cache.get("model", "text") is None
+    cache.put("model", "other", [3.0])
+    assert cache.misses == 1
+
+
+def test_unopenable_database_disables_cache(tmp_path, monkeypatch):
+    monkeypatch.setenv("EMBEDDING_CACHE_ENABLED", "1")
+    monkeypatch.setenv("EMBEDDING_CACHE_PATH", str(tmp_path / "missing" / "embedding_cache.db"))
+    monkeypatch.setattr(embedding_cache, "_cache", None)
+    monkeypatch.setattr(embedding_cache, "_failed", False)
+    assert embedding_cache.get_embedding_cache() is None
+    assert embedding_cache._failed
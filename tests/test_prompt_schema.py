@@ -0,0 +1,31 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from prompt_schema import SchemaCache  # noqa: E402
+
+
+class Result:
+
+    def __init__(self, rows):
+        self.result_rows = rows
+
+
+def failing_query(query, parameters=None):
+    raise ConnectionError("connection refused")
+
+
+def test_refresh_failure_without_schema_uses_static_schema():
+    cache = SchemaCache(failing_query)
+    assert cache.render(["page views"]) == (None, set())
+
+
+def test_refresh_failure_keeps_last_schema():
+    responses = [Result([("ga_daily", "event_date", "Date"), ("ga_daily", "event_name", "String")]),
+                 Result([("ga_daily", "event_date, event_name")])]
+    cache = SchemaCache(lambda query, parameters=None: responses.pop(0), tables=["ga_daily"], refresh_interval=0)
+    schema, _ = cache.render(["event"])
+    cache.query = failing_query
+    assert cache.render(["event"])[0] == schema
+    assert "`event_date` Date" in schema
@@ -0,0 +1,73 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("EMBEDDING_CACHE_ENABLED", "0")
+os.environ.setdefault("PHRASE_CACHE_ENABLED", "0")
+
+import question_to_sql  # noqa: E402
+
+
+def test_content_filter_single_word(monkeypatch):
+    monkeypatch.setattr(question_to_sql, "content_filter", "index")
+    assert question_to_sql.content_filter_sql(["ClickHouse"]) == "multiSearchAny(lowerUTF8(content), ['clickhouse'])"
+
+
+def test_content_filter_multi_word(monkeypatch):
+    monkeypatch.setattr(question_to_sql, "content_filter", "index")
+    assert question_to_sql.content_filter_sql(["Materialized Views", "materialized views", "O'Reilly"]) == \
+        "multiSearchAny(lowerUTF8(content), ['materialized views', 'o\\'reilly'])"
+
+
+def test_content_filter_ilike_escapes(monkeypatch):
+    monkeypatch.setattr(question_to_sql, "content_filter", "ilike")
+    assert question_to_sql.content_filter_sql(["100%_done", "back\\slash"]) == \
+        "content ILIKE '%100\\\\%\\\\_done%' OR content ILIKE '%back\\\\\\\\slash%'"
+
+
+SETTINGS = {"max_execution_time": 30, "max_rows_to_read": 1000}
+
+
+def test_add_settings_without_settings_clause():
+    assert question_to_sql.add_settings("SELECT count() FROM ga_daily;", SETTINGS) == \
+        "SELECT count() FROM ga_daily\nSETTINGS max_execution_time = 30, max_rows_to_read = 1000"
+
+
+def test_add_settings_extends_final_settings_clause():
+    assert question_to_sql.add_settings("SELECT count() FROM ga_daily SETTINGS max_threads = 4", SETTINGS) == \
+        "SELECT count() FROM ga_daily SETTINGS max_threads = 4, max_execution_time = 30, max_rows_to_read = 1000"
+
+
+def test_add_settings_ignores_inner_and_quoted_settings():
+    sql = ("SELECT count() FROM (SELECT * FROM ga_daily SETTINGS max_threads = 4) "
+           "WHERE page_title = 'settings' -- SETTINGS\n")
+    assert question_to_sql.add_settings(sql, SETTINGS) == \
+        sql.strip() + "\nSETTINGS max_execution_time = 30, max_rows_to_read = 1000"
+
+
+def test_add_settings_before_trailing_format():
+    assert question_to_sql.add_settings("SELECT count() FROM ga_daily FORMAT JSONEachRow", SETTINGS) == \
+        "SELECT count() FROM ga_daily\nSETTINGS max_execution_time = 30, max_rows_to_read = 1000\nFORMAT JSONEachRow"
+    assert question_to_sql.add_settings(
+        "SELECT count() FROM ga_daily SETTINGS max_threads = 4 FORMAT JSON", SETTINGS) == \
+        "SELECT count() FROM ga_daily SETTINGS max_threads = 4, max_execution_time = 30, max_rows_to_read = 1000" \
+        "\nFORMAT JSON"
+
+
+def test_add_settings_replaces_settings_already_set():
+    assert question_to_sql.add_settings("SELECT count() FROM ga_daily SETTINGS max_execution_time = 5, max_threads = 4",
+                                        {"max_execution_time": 30}) == \
+        "SELECT count() FROM ga_daily SETTINGS max_threads = 4, max_execution_time = 30"
+
+
+def test_unreachable_server_skips_validation(monkeypatch):
+    def unreachable(sql):
+        raise question_to_sql.OperationalError("connection refused")
+
+    def invalid(sql):
+        raise question_to_sql.DatabaseError("Code: 47. Unknown identifier")
+
+    monkeypatch.setattr(question_to_sql, "estimate_sql", unreachable)
+    assert question_to_sql.validation_feedback("SELECT 1") == (None, None)
+    monkeypatch.setattr(question_to_sql, "estimate_sql", invalid)
+    assert question_to_sql.validation_feedback("SELECT x")[1].startswith("failed with the error")
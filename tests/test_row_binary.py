@@ -0,0 +1,44 @@
+import array
+import io
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from row_binary import (encode_embedding, encode_string, leb128, read_float32_array, read_leb128,  # noqa: E402
+                        read_strings)
+
+
+def test_leb128_round_trip():
+    for value in (0, 1, 127, 128, 300, 16383, 16384, 2 ** 35):
+        encoded = leb128(value)
+        assert read_leb128(b"\xff" + encoded, 1) == (value, len(encoded) + 1)
+    assert leb128(127) == b"\x7f"
+    assert leb128(128) == b"\x80\x01"
+
+
+def test_row_binary_strings_round_trip():
+    rows = ["", "short", "é" * 200, "x" * 1000]
+    stream = io.BytesIO(b"".join(encode_string(row) for row in rows))
+    assert read_strings(stream, len(rows), "RowBinary") == rows
+    assert stream.read() == b""
+
+
+def test_row_binary_embeddings_round_trip():
+    embeddings = [array.array("f", [0.5, -1.25] * 100).tobytes(), b"", array.array("f", [3.0]).tobytes()]
+    data = b"".join(encode_embedding(embedding, "RowBinary") for embedding in embeddings)
+    decoded = []
+    offset = 0
+    while offset < len(data):
+        embedding, offset = read_float32_array(data, offset)
+        decoded.append(embedding)
+    assert decoded == embeddings
+
+
+def test_tab_separated_fallback():
+    stream = io.BytesIO("first row\nsecond é row\n".encode("utf-8"))
+    assert read_strings(stream, 2, "TabSeparated") == ["first row\n", "second é row\n"]
+    embedding = array.array("f", [0.5, -1.25]).tobytes()
+    assert json.loads(encode_embedding(embedding, "TabSeparated")) == [0.5, -1.25]
+    assert encode_embedding(b"", "TabSeparated") == b"[]\n"
@@ -0,0 +1,32 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import tracing  # noqa: E402
+
+
+class FailingClient:
+
+    def insert(self, **kwargs):
+        raise ConnectionError("connection refused")
+
+
+def test_failing_trace_table_does_not_fail_the_stage(monkeypatch):
+    monkeypatch.delenv("TRACE_FILE", raising=False)
+    monkeypatch.setenv("TRACE_TABLE", "pipeline_traces")
+    monkeypatch.setenv("TRACE_BATCH_SIZE", "1")
+    tracing.configure(FailingClient)
+
+    @tracing.traced("stage")
+    def stage():
+        return 42
+
+    try:
+        assert stage() == 42
+        monkeypatch.setenv("TRACE_BATCH_SIZE", "100")
+        tracing.configure(FailingClient)
+        assert stage() == 42
+        tracing.flush()
+    finally:
+        tracing._sinks.clear()
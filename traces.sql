@@ -0,0 +1,44 @@
+-- spans written by tracing.py when TRACE_TABLE=pipeline_traces
+
+CREATE TABLE pipeline_traces
+(
+    `trace_id` String,
+    `span_id` String,
+    `parent_id` Nullable(String),
+    `stage` LowCardinality(String),
+    `start` DateTime64(3),
+    `duration_ms` Float64,
+    `retries` UInt32,
+    `throttles` UInt32,
+    `prompt_bytes` UInt64,
+    `input_tokens` UInt64,
+    `output_tokens` UInt64,
+    `rows_read` UInt64,
+    `bytes_read` UInt64,
+    `estimated_parts` UInt64,
+    `estimated_rows` UInt64,
+    `estimated_bytes` UInt64,
+    `error` String
+)
+ENGINE = MergeTree
+ORDER BY (stage, start)
+TTL toDateTime(start) + INTERVAL 30 DAY
+
+
+-- latency, retries and throttling per stage over the last day
+
+SELECT
+    stage,
+    count() AS calls,
+    quantile(0.5)(duration_ms) AS p50_ms,
+    quantile(0.99)(duration_ms) AS p99_ms,
+    sum(retries) AS retries,
+    sum(throttles) AS throttles,
+    sum(input_tokens) AS input_tokens,
+    sum(output_tokens) AS output_tokens,
+    sum(rows_read) AS rows_read,
+    formatReadableSize(sum(bytes_read)) AS read
+FROM pipeline_traces
+WHERE start > now() - INTERVAL 1 DAY
+GROUP BY stage
+ORDER BY p99_ms DESC
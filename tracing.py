@@ -0,0 +1,216 @@
+"""Per-stage tracing for the RAG pipeline and embed UDF.
+
+Each stage runs in a span recording its wall time, Bedrock retries and throttling, prompt and completion sizes,
+and the rows and bytes ClickHouse read. Spans are linked to the question (or UDF chunk) they belong to by a trace id
+and written as JSON lines to a local file and/or batch inserted into the ClickHouse table defined in traces.sql.
+
+Configured through the environment:
+    TRACE_FILE - JSONL file to append spans to
+    TRACE_TABLE - ClickHouse table to insert spans into e.g. pipeline_traces. Not used by the embed UDF
+    TRACE_BATCH_SIZE - number of spans buffered before an insert into TRACE_TABLE (default 100)
+"""
+import atexit
+import contextvars
+import functools
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+FIELDS = ["trace_id", "span_id", "parent_id", "stage", "start", "duration_ms", "retries", "throttles",
+          "prompt_bytes", "input_tokens", "output_tokens", "rows_read", "bytes_read", "estimated_parts",
+          "estimated_rows", "estimated_bytes", "error"]
+
+_current_span = contextvars.ContextVar("span", default=None)
+
+
+class Span:
+
+    def __init__(self, stage, trace_id, parent_id=None):
+        self.trace_id = trace_id
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.stage = stage
+        self.start = time.time()
+        self.duration_ms = 0.0
+        self.retries = 0
+        self.throttles = 0
+        self.prompt_bytes = 0
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self.rows_read = 0
+        self.bytes_read = 0
+        self.estimated_parts = 0
+        self.estimated_rows = 0
+        self.estimated_bytes = 0
+        self.error = ""
+        self._started = time.perf_counter()
+
+    def finish(self):
+        self.duration_ms = (time.perf_counter() - self._started) * 1000
+
+    def to_dict(self):
+        return {field: getattr(self, field) for field in FIELDS}
+
+
+class JsonlSink:
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def emit(self, span):
+        line = json.dumps(span.to_dict()) + "\n"
+        with self.lock:
+            with open(self.path, "a") as trace_file:
+                trace_file.write(line)
+
+    def flush(self):
+        pass
+
+
+class ClickHouseSink:
+    """Buffers spans and inserts them into a ClickHouse table in batches"""
+
+    def __init__(self, table, client_factory, batch_size=100):
+        self.table = table
+        self.client_factory = client_factory
+        self.batch_size = batch_size
+        self.lock = threading.Lock()
+        self.rows = []
+
+    def emit(self, span):
+        with self.lock:
+            row = span.to_dict()
+            row["start"] = datetime.fromtimestamp(span.start, tz=timezone.utc)
+            self.rows.append([row[field] for field in FIELDS])
+            if len(self.rows) < self.batch_size:
+                return
+            rows, self.rows = self.rows, []
+        self._insert(rows)
+
+    def flush(self):
+        with self.lock:
+            rows, self.rows = self.rows, []
+        if rows:
+            self._insert(rows)
+
+    def _insert(self, rows):
+        self.client_factory().insert(table=self.table, data=rows, column_names=FIELDS)
+
+
+_sinks = []
+
+
+def configure(client_factory=None):
+    """Creates the sinks configured in the environment. client_factory returns a ClickHouse client for TRACE_TABLE"""
+    _sinks.clear()
+    if os.getenv("TRACE_FILE"):
+        _sinks.append(JsonlSink(os.getenv("TRACE_FILE")))
+    if os.getenv("TRACE_TABLE") and client_factory is not None:
+        _sinks.append(ClickHouseSink(os.getenv("TRACE_TABLE"), client_factory,
+                                     batch_size=int(os.getenv("TRACE_BATCH_SIZE", default=100))))
+
+
+def flush():
+    for sink in _sinks:
+        try:
+            sink.flush()
+        except Exception as e:
+            logging.warning(f"trace flush failed: {e}")
+
+
+atexit.register(flush)
+
+
+@contextmanager
+def span(stage):
+    """Runs the enclosed block as a stage, nested within the current span if there is one"""
+    parent = _current_span.get()
+    current = Span(stage, parent.trace_id if parent else uuid.uuid4().hex, parent.span_id if parent else None)
+    token = _current_span.set(current)
+    try:
+        yield current
+    except Exception as e:
+        current.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        current.finish()
+        _current_span.reset(token)
+        # a failing sink loses the span rather than failing the stage
+        for sink in _sinks:
+            try:
+                sink.emit(current)
+            except Exception as e:
+                logging.warning(f"trace emit failed: {e}")
+
+
+def traced(stage):
+    """Decorator running a function as a stage"""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(stage):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def is_throttling(exception):
+    response = getattr(exception, "response", None) or {}
+    return response.get("Error", {}).get("Code") == "ThrottlingException"
+
+
+def record_retry(retry_state):
+    """tenacity before_sleep callback counting retries and throttling against the current span"""
+    current = _current_span.get()
+    if current is None:
+        return
+    current.retries += 1
+    if retry_state.outcome is not None and retry_state.outcome.failed \
+            and is_throttling(retry_state.outcome.exception()):
+        current.throttles += 1
+
+
+def record_bedrock(body, response):
+    """Records the prompt size and the token counts Bedrock returns in its response headers"""
+    current = _current_span.get()
+    if current is None:
+        return
+    headers = response.get("ResponseMetadata", {}).get("HTTPHeaders", {})
+    current.prompt_bytes += len(body)
+    current.input_tokens += int(headers.get("x-amzn-bedrock-input-token-count", 0))
+    current.output_tokens += int(headers.get("x-amzn-bedrock-output-token-count", 0))
+
+
+def record_tokens(input_tokens, output_tokens):
+    """Records token counts reported in the body of a response, as streamed responses do"""
+    current = _current_span.get()
+    if current is None:
+        return
+    current.input_tokens += int(input_tokens)
+    current.output_tokens += int(output_tokens)
+
+
+def record_query(result):
+    """Records the rows and bytes read from the summary of a clickhouse_connect query result"""
+    current = _current_span.get()
+    summary = getattr(result, "summary", None) or {}
+    if current is None:
+        return
+    current.rows_read += int(summary.get("read_rows", 0))
+    current.bytes_read += int(summary.get("read_bytes", 0))
+
+
+def record_estimate(estimate):
+    """Records the parts, rows and bytes EXPLAIN ESTIMATE expects a statement to read"""
+    current = _current_span.get()
+    if current is None:
+        return
+    current.estimated_parts += int(estimate["parts"])
+    current.estimated_rows += int(estimate["rows"])
+    current.estimated_bytes += int(estimate["bytes"])
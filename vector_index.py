@@ -0,0 +1,47 @@
+"""Small in-memory vector index for brute force nearest neighbour search with NumPy.
+
+Intended for small candidate sets, such as the questions table, where a vectorized scan of a contiguous float32
+matrix is faster than a round trip to ClickHouse.
+"""
+import numpy as np
+
+
+class VectorIndex:
+
+    def __init__(self, vectors, payloads, metric="l2"):
+        if metric not in ("l2", "cosine"):
+            raise ValueError(f"unsupported metric {metric}")
+        self.metric = metric
+        self.payloads = list(payloads)
+        matrix = np.asarray(vectors, dtype=np.float32)
+        if matrix.size == 0:
+            matrix = matrix.reshape(0, 0)
+        self.matrix = np.ascontiguousarray(matrix)
+        # squared norms are precomputed once so a search is a single matrix product
+        self.squared_norms = np.einsum("ij,ij->i", self.matrix, self.matrix)
+        self.norms = np.sqrt(self.squared_norms)
+
+    def __len__(self):
+        return len(self.payloads)
+
+    def distances(self, queries):
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        dots = queries @ self.matrix.T
+        query_squared_norms = np.einsum("ij,ij->i", queries, queries)
+        if self.metric == "l2":
+            return np.sqrt(np.maximum(self.squared_norms[None, :] - 2 * dots + query_squared_norms[:, None], 0))
+        denominator = self.norms[None, :] * np.sqrt(query_squared_norms)[:, None]
+        return 1 - dots / np.where(denominator == 0, 1, denominator)
+
+    def search(self, queries, k=1):
+        """Returns the payloads of the k nearest vectors, closest first, for each query"""
+        if len(self) == 0:
+            return [[] for _ in range(len(queries))]
+        k = min(k, len(self))
+        distances = self.distances(queries)
+        nearest = np.argpartition(distances, k - 1, axis=1)[:, :k]
+        results = []
+        for row, candidates in zip(distances, nearest):
+            ordered = candidates[np.argsort(row[candidates])]
+            results.append([self.payloads[i] for i in ordered])
+        return results